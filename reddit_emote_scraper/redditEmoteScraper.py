@@ -17,11 +17,13 @@
 import logging
 import argparse
 import time
-from reddit_emote_scraper.ratelimiter import TokenBucket
+from reddit_emote_scraper.ratelimiter import TokenBucket, HostRateScheduler
+from reddit_emote_scraper.replay import Recorder
 from reddit_emote_scraper import RedditEmoteScraper
+from reddit_emote_scraper.RedditEmoteScraper import NoCheckpointException, UnknownStageException, ShardMergeException
+from reddit_emote_scraper.daemon import ScrapeDaemon
 from data import subreddits, image_blacklist, nsfw_subreddits, broken_emotes, emote_info
-from os import path
-import json
+import sys
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +35,6 @@ scraper.image_blacklist = image_blacklist
 scraper.nsfw_subreddits = nsfw_subreddits
 scraper.broken_emotes = broken_emotes
 scraper.emote_info = emote_info
-scraper.rate_limit_lock = TokenBucket(15, 30)
 
 parser = argparse.ArgumentParser(description='Scrape emoticons from reddit.com\'s subreddits. Outputs them as json and a load of cut-out images.')
 
@@ -134,53 +135,224 @@ parser.add_argument(
     default="output",
 )
 
+parser.add_argument(
+    '-bps', '--max-bytes-per-second',
+    help="Limit the download speed of images to this many bytes per second",
+    dest="max_bytes_per_second",
+    type=int,
+    default=None,
+)
+
+parser.add_argument(
+    '-sd', '--stage-deadline',
+    help="Give up on the remaining downloads of a download phase after this many seconds",
+    dest="stage_deadline",
+    type=float,
+    default=None,
+)
+
+parser.add_argument(
+    '-w', '--workers',
+    help="Number of concurrent requests to start with, adjusted between --min-workers and --max-workers",
+    dest="workers",
+    type=int,
+    default=20,
+)
+
+parser.add_argument(
+    '--min-workers',
+    help="Lowest number of concurrent requests",
+    dest="min_workers",
+    type=int,
+    default=2,
+)
+
+parser.add_argument(
+    '--max-workers',
+    help="Highest number of concurrent requests",
+    dest="max_workers",
+    type=int,
+    default=50,
+)
+
+parser.add_argument(
+    '--pool-size',
+    help="Keep-alive connections kept per host (default: --max-workers)",
+    dest="pool_size",
+    type=int,
+    default=None,
+)
+
+parser.add_argument(
+    '-vc', '--verify-cache',
+    help="Verify the structure of cached images before downloading, broken images are downloaded again",
+    action="store_const",
+    dest="verify_cache",
+    const=True,
+    default=False,
+)
+
+parser.add_argument(
+    '--record',
+    help="Record all downloaded responses in this directory, for use with the replay server (python -m reddit_emote_scraper.replay)",
+    dest="record",
+    default=None,
+)
+
+parser.add_argument(
+    '--replay-server',
+    help="Make all requests to this replay server (like http://127.0.0.1:8080) instead of reddit",
+    dest="replay_server",
+    default=None,
+)
+
+parser.add_argument(
+    '-s', '--stream',
+    help="Fetch, parse, download and extract every subreddit on its own as soon as its inputs are ready",
+    action="store_const",
+    dest="stream",
+    const=True,
+    default=False,
+)
+
+parser.add_argument(
+    '--stream-window',
+    help="Number of subreddits between fetching and extracting at the same time when streaming",
+    dest="stream_window",
+    type=int,
+    default=8,
+)
+
+parser.add_argument(
+    '--from-stage',
+    help="Resume at this stage with the state checkpointed in the session cache by an earlier run",
+    dest="from_stage",
+    default=None,
+)
+
+parser.add_argument(
+    '--to-stage',
+    help="Stop after this stage. Emotes are only exported if the last stage ran",
+    dest="to_stage",
+    default=None,
+)
+
+parser.add_argument(
+    '--no-checkpoints',
+    help="Do not save the state between stages, so independent stages can run at the same time. Runs can not be resumed with --from-stage",
+    dest="checkpoints",
+    action='store_false',
+    default=True,
+)
+
+def shard(value):
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected INDEX/COUNT, like 0/4")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("INDEX must be from 0 to COUNT - 1")
+    return (index, count)
+
+parser.add_argument(
+    '--shard',
+    help="Only fetch, download and extract shard INDEX/COUNT of the subreddits (like 0/4), for --merge-shards to combine. Shards share the cache, session and output directories",
+    dest="shard",
+    type=shard,
+    default=None,
+)
+
+parser.add_argument(
+    '--merge-shards',
+    help="Combine the results of this many --shard runs and run the remaining stages",
+    dest="merge_shards",
+    type=int,
+    default=None,
+)
+
+parser.add_argument(
+    '--daemon',
+    help="Keep running: poll every subreddit's stylesheet on an interval learned from how often it changes, and update the output when one changed",
+    action="store_const",
+    dest="daemon",
+    const=True,
+    default=False,
+)
+
+parser.add_argument(
+    '--min-poll-interval',
+    help="Seconds between polls of a stylesheet that changes often (with --daemon)",
+    dest="min_poll_interval",
+    type=float,
+    default=600,
+)
+
+parser.add_argument(
+    '--max-poll-interval',
+    help="Seconds between polls of a stylesheet that never changes (with --daemon)",
+    dest="max_poll_interval",
+    type=float,
+    default=86400,
+)
+
 args = parser.parse_args()
 logging.basicConfig(level=args.loglevel)
 
+# The reddit api and the image hosts have their own budgets,
+# image downloads do not have to wait for the stylesheet budget.
+scraper.rate_limit_lock = HostRateScheduler(default=TokenBucket(15, 30))
+scraper.rate_limit_lock.add_host('reddit.com', TokenBucket(15, 30))
+scraper.rate_limit_lock.add_host(['thumbs.redditmedia.com', 's3.amazonaws.com'],
+                                 TokenBucket(50, 1),
+                                 max_bytes_per_second=args.max_bytes_per_second)
+
 scraper.css_fallbacks = args.css_fallbacks
 scraper.reddit_cache = args.reddit_cache
 scraper.session_cache = args.session_cache
 scraper.output_dir = args.output_dir
+scraper.stage_deadline = args.stage_deadline
+scraper.workers = args.workers
+scraper.min_workers = args.min_workers
+scraper.max_workers = args.max_workers
+scraper.pool_size = args.pool_size
+scraper.stream_window = args.stream_window
+scraper.replay_server = args.replay_server
+scraper.checkpoints = args.checkpoints
+if args.record:
+    scraper.recorder = Recorder(args.record)
+
+if args.daemon:
+    daemon = ScrapeDaemon(scraper,
+                          args.min_poll_interval,
+                          args.max_poll_interval,
+                          berrytube_tags=args.berrytube_tags,
+                          bpm_tags=args.bpm_tags,
+                          verify_cache=args.verify_cache)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        logger.info("Stopping the daemon.")
+    finally:
+        scraper.close()
+    sys.exit(0)
 
 start = time.time()
-if(args.berrytube_tags):
-    scraper.download_bt_v2_tags()
-if(args.bpm_tags):
-    scraper.download_bpm_tags()
-if(args.cssdownload):
-    scraper.fetch_css()
-scraper.process_stylesheets()
-scraper.dedupe_emotes()
-scraper.add_bt_tags()
-scraper.add_bt_v2_tags()
-scraper.add_bpm_tags()
-scraper.download_images()
-scraper.extract_images_from_spritemaps()
-scraper.cropEmotes()
-# This following command will read the old emotes. It sets the modified date.
-scraper.read_old_emotes()
-scraper.remove_broken_emotes()
-scraper.visually_dedupe_emotes()
-scraper.emote_post_preferance()
-scraper.remove_garbage()
+try:
+    finished = scraper.scrape(from_stage=args.from_stage,
+                              to_stage=args.to_stage,
+                              download_css=args.cssdownload,
+                              berrytube_tags=args.berrytube_tags,
+                              bpm_tags=args.bpm_tags,
+                              verify_cache=args.verify_cache,
+                              stream=args.stream,
+                              shard=args.shard,
+                              merge_shards=args.merge_shards)
+except (NoCheckpointException, UnknownStageException, ShardMergeException) as ex:
+    parser.exit(2, "{}: error: {}\n".format(parser.prog, ex))
+finally:
+    scraper.close()
 logger.info("Finished scrape in {}.".format(time.time() - start))
-emotes = scraper.export_emotes()
-
-FILENAME = path.join(scraper.output_dir, 'emotes_metadata')
-
-with open(FILENAME + '.min.js', 'w') as f:
-    f.write("var emotes_metadata = ")
-    json.dump(emotes, fp=f, separators=(',', ':'), sort_keys=True)
-    f.write(";")
-
-with open(FILENAME + '.js', 'w') as f:
-    f.write("var emotes_metadata = ")
-    json.dump(emotes, fp=f, separators=(',', ':'), sort_keys=True, indent=2)
-    f.write(";")
-
-with open(FILENAME + '.min.json', 'w') as f:
-    json.dump(emotes, fp=f, separators=(',', ':'), sort_keys=True)
-
-with open(FILENAME + '.json', 'w') as f:
-    json.dump(emotes, fp=f, separators=(',', ':'), sort_keys=True, indent=2)
-
+if not finished:
+    logger.info("Emotes are incomplete (stopped after a stage or ran a shard), not exporting them.")
+    sys.exit(0)
+scraper.write_emotes_metadata()
@@ -15,18 +15,30 @@ from datetime import datetime, timedelta
 import time
 import calendar
 from email.utils import parsedate
-from dateutil.tz import tzutc
-import requests
-from workerpool import WorkerPool
 import threading
-import tinycss
+from Queue import Queue, Empty
 import re
-from collections import defaultdict
 import itertools
+import functools
 import os
-from os import path, utime
+from os import path
 from .downloadjob import DownloadJob
+from .fetchengine import FetchEngine
+from .stages import Stage, StageExecutor
+from .circuitbreaker import CircuitBreaker
+from .concurrency import ConcurrencyController
+from .validatorstore import ValidatorStore
+from .inflight import InFlight
+from .downloadjournal import DownloadJournal, QUEUED, COMPLETED, FAILED
+from .imageverify import find_broken_images
+from .stylesheet import create_pool, process_stylesheet, process_stylesheets, PARSER_VERSION
+from .stylesheetcache import ParsedStylesheetCache
+from .telemetry import FetchTelemetry
+from .replay import replay_url, original_url
+from .manifest import EmoteManifest, OUTPUT_KEYS, declarations_hash, diff_rules
+from .manifest import ADDED, REMOVED, CHANGED, UNCHANGED
 from .filenameutils import get_file_path
+from .fileutils import makedirs, write_atomic, write_response_atomic, symlink_atomic
 from .emote import get_single_image_path
 from .emote import get_single_hover_image_path
 from .emote import extract_single_image
@@ -38,15 +50,8 @@ from .emote import calculateCrop
 from .emote import get_explode_directory
 from .emote import setPosition
 from .emote import getPosition
-from dateutil import parser
-from PIL import Image
-import pypuzzle
 import shutil
-from sh import apngasm
 from glob import glob
-from lxml import etree
-import execjs
-import tempfile
 import pickle
 import urlparse
 import json
@@ -61,6 +66,29 @@ re_slash = re.compile(r"/")
 class NoCSSFoundException(Exception):
     pass
 
+class NoCheckpointException(Exception):
+    pass
+
+class UnknownStageException(Exception):
+    pass
+
+class ShardMergeException(Exception):
+    pass
+
+# Heavy and native dependencies (requests, tinycss, PIL, lxml, sh, execjs,
+# pypuzzle) are imported by the stages that use them, so importing this
+# module is fast and runs that skip those stages do not need them.
+
+_apngasm = None
+
+def apngasm(*args):
+    '''Runs apngasm, sh looks the command up when it is imported so that is done once on first use'''
+    global _apngasm
+    if _apngasm is None:
+        from sh import apngasm as command
+        _apngasm = command
+    return _apngasm(*args)
+
 def _remove_duplicates(seq):
     '''https://stackoverflow.com/questions/480214/how-do-you-remove-duplicates-from-a-list-in-python-whilst-preserving-order'''
     seen = set()
@@ -81,13 +109,55 @@ class RedditEmoteScraper():
         self.reddit_cache = 'cache'
         self.session_cache = 'session_cache'
         self.output_dir = 'output'
+        # Requests in flight start at workers and are adjusted between min_workers and max_workers
         self.workers = 20
+        self.min_workers = 2
+        self.max_workers = 50
+        self.concurrency = None
         self.rate_limit_lock = None
+        self.validators = None
+        self._engine = None
+        # Pipeline stages that may run at the same time
+        self.stage_workers = 4
+        # Subreddits between fetching and extracting at the same time when streaming
+        self.stream_window = 8
+        # Processes parsing stylesheets in process_stylesheets() and verifying the cache, None for one per cpu
+        self.parse_processes = None
+        self._pool = None
+        self.stylesheet_cache = None
+        # Save the state between stages to the session cache, so a scrape can be resumed at a stage.
+        # The stages then run one at a time instead of overlapping.
+        self.checkpoints = True
+        self.old_emotes = None
+        self._executor = None
+        # (connect, read) timeout of every request in seconds
+        self.timeout = (10, 60)
+        # Seconds a download phase may take before its remaining jobs give up, None for no limit
+        self.stage_deadline = None
+        self.circuit_breaker = CircuitBreaker()
+        self._in_flight = InFlight()
+        # Keep-alive connections kept per host, None to size the pool to max_workers
+        self.pool_size = None
+        # Number of hosts a connection pool is kept for
+        self.pool_hosts = 10
+        self._over18 = False
+        # Images that failed this many times (in earlier runs) are not retried
+        self.max_download_failures = 3
+        self.telemetry = FetchTelemetry()
+        # Url of a replay.ReplayServer to make all requests to instead of reddit
+        self.replay_server = None
+        # replay.Recorder that stores every downloaded response
+        self.recorder = None
+        self.manifest = None
+        # Input hashes of the emotes and the emotes whose outputs were restored from the manifest
+        self._emote_inputs = {}
+        self._unchanged_emotes = set()
+        # Rule set of every parsed subreddit
+        self._emote_rules = {}
 
         self.mutex = threading.RLock()
 
-        self._requests = requests.Session()
-        self._requests.headers = {'user-agent', 'User-Agent: emoticon harvester v2.1'}
+        self._requests = None
 
     def _remove_images_emote(self, emote):
         try:
@@ -120,181 +190,298 @@ class RedditEmoteScraper():
         keeper['tags'] = keeper.get('tags', []) + goner.get('tags', [])
         goner['names'] = []
 
-    def download_bt_v2_tags(self):
-        logger.info('Beginning download_bt_tags()')
-        download_location = os.path.join(self.session_cache, "bt-tags.v2.json")
-        if not os.path.exists(download_location):
-            with open(download_location, "w") as f:
-                f.write(self._requests.get("https://cdn.berrytube.tv/sha1/zu5qdzSDZFLN6QV-VHMwKOwstqI/berrymotes/data/berrymotes_json_data.v2.json").text)
+    def _validator_store(self):
+        '''The validator store lives in the reddit cache, it is created on first use'''
+        with self.mutex:
+            if self.validators is None:
+                self.validators = ValidatorStore(path.join(self.reddit_cache, 'validators.json'))
+            return self.validators
 
-    def download_bpm_tags(self):
-        logger.info('Beginning download_bpm_tags()')
-        download_location = os.path.join(self.session_cache, "bpm-resources.js")
-        if not os.path.exists(download_location):
-            with open(download_location, "w") as f:
-                f.write(self._requests.get("https://ponymotes.net/bpm/bpm-resources.js").text)
+    def _http_session(self):
+        '''The http session is created on first use, runs without downloads do not import requests'''
+        with self.mutex:
+            if self._requests is None:
+                import requests
+                self._requests = requests.Session()
+                self._requests.headers['User-Agent'] = 'emoticon harvester v2.1'
+            return self._requests
+
+    def _emote_manifest(self):
+        '''The manifest lives next to the output it describes, it is created on first use'''
+        with self.mutex:
+            if self.manifest is None:
+                self.manifest = EmoteManifest(path.join(self.output_dir, 'emotes_manifest.json'))
+            return self.manifest
 
-    def fetch_css(self):
-        logger.info('Beginning fetch_css()')
+    def _stylesheet_cache(self):
+        '''Parsed stylesheets are cached in the reddit cache, the cache is created on first use'''
+        with self.mutex:
+            if self.stylesheet_cache is None:
+                self.stylesheet_cache = ParsedStylesheetCache(path.join(self.reddit_cache, 'parsed_css'), PARSER_VERSION)
+            return self.stylesheet_cache
 
-        logger.debug("Fetching css using {} threads".format(self.workers))
-        workpool = WorkerPool(size=self.workers)
+    def _process_pool(self):
+        '''
+        The process pool of process_stylesheets() and verify_cache(), created on first use.
 
-        for subreddit in self.subreddits:
-            try:
-                css_subreddit_path = path.join(self.session_cache, subreddit.lower()) + '.css'
-                with open(css_subreddit_path, 'r') as f:
-                    pass
-            except:
-                workpool.put(DownloadJob(self._requests,
-                                         'https://pay.reddit.com/r/{}/stylesheet'.format(subreddit),
-                                         retry=5,
-                                         rate_limit_lock=self.rate_limit_lock,
-                                         callback=self._callback_fetch_stylesheet,
-                                         **{'subreddit': subreddit}))
-
-        workpool.shutdown()
-        workpool.join()
-
-    def _callback_fetch_stylesheet(self, response, subreddit):
-        if not response:
-            logger.error("Failed to fetch css for {}".format(subreddit))
-            return
+        scrape() creates it before the stages start their threads, see stylesheet.create_pool().
+        '''
+        with self.mutex:
+            if self._pool is None:
+                self._pool = create_pool(self.emote_info, self.nsfw_subreddits, self.image_blacklist,
+                                         self._stylesheet_cache(), self.parse_processes)
+            return self._pool
 
-        if response.status_code != 200:
-            logger.error("Failed to fetch css for {} (Status {})".format(subreddit, response.status_code))
-            return
+    def _fetch_engine(self):
+        '''The fetch engine is shared by all download phases, it is started on first use'''
+        with self.mutex:
+            if self._engine is None:
+                self._mount_connection_pools()
+                self.concurrency = ConcurrencyController(initial=self.workers,
+                                                         minimum=self.min_workers,
+                                                         maximum=self.max_workers)
+                self._engine = FetchEngine(controller=self.concurrency)
+                self._engine.start()
+            return self._engine
+
+    def _stage_executor(self):
+        '''The stage executor is kept for all scrapes of this scraper, it is started on first use'''
+        with self.mutex:
+            if self._executor is None:
+                self._executor = StageExecutor(workers=self.stage_workers)
+                self._executor.start()
+            return self._executor
 
-        text = response.text.encode('utf-8')
-        modified_date_tuple = parsedate(response.headers['Last-Modified'])
-        modified_date_timestamp = calendar.timegm(modified_date_tuple)
+    def _mount_connection_pools(self):
+        '''
+        The default adapter keeps 10 connections per host, fewer than the number of
+        requests we have in flight. Excess connections would be closed after every request.
+        '''
+        from .httpadapter import TimedHTTPAdapter
+        adapter = TimedHTTPAdapter(self.telemetry,
+                                   pool_connections=self.pool_hosts,
+                                   pool_maxsize=self.pool_size or self.max_workers)
+        self._http_session().mount('https://', adapter)
+        self._http_session().mount('http://', adapter)
+
+    def _prime_over18(self):
+        '''
+        Accept the reddit over18 interstitial once for the whole session.
 
-        css_cache_file_path = get_file_path(response.url, rootdir=self.reddit_cache )
+        Without the cookie every request for a nsfw subreddit is redirected
+        and needs a second (POST) request.
+        '''
         with self.mutex:
-            if not os.path.exists(os.path.dirname(css_cache_file_path)):
-                os.makedirs(os.path.dirname(css_cache_file_path))
-        css_subreddit_path = path.join(self.session_cache, subreddit.lower()) + '.css'
+            if self._over18:
+                return
+            self._http_session().cookies.set('over18', '1', domain='.reddit.com', path='/')
+            self._over18 = True
+
+    def _url(self, url):
+        '''The url to request for url, which is different when replaying'''
+        if self.replay_server:
+            return replay_url(self.replay_server, url)
+        return url
+
+    def _response_url(self, response):
+        '''The url response came from, the original url when replaying'''
+        server = self.replay_server.rstrip('/') if self.replay_server else None
+        if server and response.url.startswith(server + '/'):
+            return original_url(response.url[len(server):])
+        return response.url
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._engine is not None:
+            self._engine.shutdown()
+            self._engine = None
+        if self.recorder is not None:
+            self.recorder.save()
+
+    def _byte_counter(self, url):
+        '''Charges the bytes of a response body from url to its rate limit budget as they are written'''
+        if self.rate_limit_lock is None:
+            return None
+        return functools.partial(self.rate_limit_lock.consume_bytes, url)
+
+    def _download_to_session(self, url, download_location):
+        '''
+        Download url to download_location in the session cache.
 
-        with open( css_cache_file_path, 'w' ) as f:
-            f.write( text )
+        A copy is kept in the reddit cache so the next session can make a conditional request.
+        '''
+        if os.path.exists(download_location):
+            return
 
-        utime(css_cache_file_path, (time.time(), modified_date_timestamp))
+        validators = self._validator_store()
+        response = self._http_session().get(self._url(url), headers=validators.headers(url), timeout=self.timeout, stream=True)
+
+        if response.status_code == 304:
+            logger.debug("{} not modified, using cached copy".format(url))
+            if self.recorder:
+                self.recorder.record(url, response, validators.get_path(url))
+            shutil.copyfile(validators.get_path(url), download_location)
+        elif response.status_code == 200:
+            cache_file_path = get_file_path(url, rootdir=self.reddit_cache)
+            write_response_atomic(response, cache_file_path, decode_unicode=True, consume_bytes=self._byte_counter(url))
+            validators.update(url, response, cache_file_path)
+            if self.recorder:
+                self.recorder.record(url, response, cache_file_path)
+            shutil.copyfile(cache_file_path, download_location)
+        else:
+            logger.error("Failed to fetch {} (Status {})".format(url, response.status_code))
+        response.close()
 
-        os.symlink(os.path.relpath(css_cache_file_path, self.session_cache + '/'), css_subreddit_path );
+        validators.save()
 
-    def _parse_css(self, data):
-        cssparser = tinycss.make_parser('page3')
-        css = cssparser.parse_stylesheet(data)
+    def download_bt_v2_tags(self):
+        logger.info('Beginning download_bt_tags()')
+        download_location = os.path.join(self.session_cache, "bt-tags.v2.json")
+        self._download_to_session("https://cdn.berrytube.tv/sha1/zu5qdzSDZFLN6QV-VHMwKOwstqI/berrymotes/data/berrymotes_json_data.v2.json", download_location)
 
-        if not css:
+    def download_bpm_tags(self):
+        logger.info('Beginning download_bpm_tags()')
+        download_location = os.path.join(self.session_cache, "bpm-resources.js")
+        self._download_to_session("https://ponymotes.net/bpm/bpm-resources.js", download_location)
+
+    def _create_download_job(self, url, deadline, callback, callbackargs, retry=5, journal=None):
+        return DownloadJob(self._http_session(),
+                           url,
+                           retry=retry,
+                           rate_limit_lock=self.rate_limit_lock,
+                           validators=self._validator_store(),
+                           timeout=self.timeout,
+                           circuit_breaker=self.circuit_breaker,
+                           deadline=deadline,
+                           concurrency=self.concurrency,
+                           journal=journal,
+                           telemetry=self.telemetry,
+                           replay_server=self.replay_server,
+                           callback=callback,
+                           **callbackargs)
+
+    def _stage_deadline(self):
+        if self.stage_deadline is None:
             return None
+        return time.time() + self.stage_deadline
 
-        re_emote = re.compile('a\[href[|^$]?=["\']/([\w:]+)["\']\](:hover)?(\sem|\sstrong)?')
-        emotes_staging = defaultdict(dict)
-
-        for rule in css.rules:
-            if re_emote.match(rule.selector.as_css()):
-                for match in re_emote.finditer(rule.selector.as_css()):
-                    rules = {}
-
-                    for declaration in rule.declarations:
-                        if match.group(3):
-                            name = match.group(3).strip() + '-' + declaration.name
-                            rules[name] = declaration.value.as_css()
-                            emotes_staging[match.group(1)].update(rules)
-                        elif declaration.name in ['text-align',
-                                                  'line-height',
-                                                  'color'] or declaration.name.startswith('font') or declaration.name.startswith('text'):
-                            name = 'text-' + declaration.name
-                            rules[name] = declaration.value.as_css()
-                            emotes_staging[match.group(1)].update(rules)
-                        elif declaration.name in ['width',
-                                                   'height',
-                                                   'background-image',
-                                                   'background-position',
-                                                   'background',
-                                                   'background-size',
-                                                  ]:
-                            name = declaration.name
-                            if name == 'background-position':
-                                val = ['{}{}'.format(v.value, v.unit if v.unit else '') for v in declaration.value if
-                                       v.value != ' ']
-                            else:
-                                val = declaration.value[0].value
-                            if match.group(2):
-                                name = 'hover-' + name
-                            rules[name] = val
-                            emotes_staging[match.group(1)].update(rules)
-        return emotes_staging
-
-    def _process_stylesheet(self, content, subreddit):
-        emotes = []
-        emotes_staging = self._parse_css(content)
-        if not emotes_staging:
-            return
+    def _stylesheet_url(self, subreddit):
+        return 'https://pay.reddit.com/r/{}/stylesheet'.format(subreddit)
 
-        key_func = lambda e: e[1]
-        for emote, group in itertools.groupby(sorted(emotes_staging.iteritems(), key=key_func), key_func):
-            emote['names'] = [a[0].encode('ascii', 'ignore') for a in group]
+    def fetch_css(self):
+        logger.info('Beginning fetch_css()')
 
-            full_names = []
-            for name in emote['names']:
-                full_names.append('r/'+subreddit+'/'+name)
-            emote['names'] = emote['names'] + full_names
-            emote['canonical'] = max(emote['names'], key=len)
+        batch = self._fetch_engine().batch()
+        self.telemetry.reset()
+        logger.debug("Fetching css using {} concurrent requests".format(self.concurrency.limit))
+        deadline = self._stage_deadline()
+        if self.nsfw_subreddits:
+            self._prime_over18()
 
-            for name in emote['names']:
-                meta_data = next((x for x in self.emote_info if x['name'] == name), None)
+        for subreddit in self.subreddits:
+            self._queue_stylesheet(subreddit, batch, deadline)
 
+        batch.join()
+        self._validator_store().save()
+        self.telemetry.write_report(path.join(self.session_cache, 'telemetry_fetch_css.json'))
 
-                if meta_data:
-                    for key, val in meta_data.iteritems():
-                        if key != 'name':
-                            emote[key] = val
+    def poll_stylesheets(self, subreddits):
+        '''
+        Fetches the stylesheets of subreddits again, with conditional requests.
 
-            if subreddit in self.nsfw_subreddits:
-                emote['nsfw'] = True
-            emote['sr'] = subreddit
+        Returns the subreddits whose stylesheet changed. A stylesheet that
+        could not be fetched is kept as it was.
+        '''
+        logger.info('Beginning poll_stylesheets()')
+        batch = self._fetch_engine().batch()
+        self.telemetry.reset()
+        deadline = self._stage_deadline()
+        if self.nsfw_subreddits:
+            self._prime_over18()
+
+        before = {}
+        for subreddit in subreddits:
+            css_subreddit_path = path.join(self.session_cache, subreddit.lower()) + '.css'
+            before[subreddit] = self._stylesheet_version(css_subreddit_path)
+            try:
+                os.remove(css_subreddit_path)
+            except OSError:
+                pass
+            self._queue_stylesheet(subreddit, batch, deadline)
 
-            validEmote = True
+        batch.join()
+        self._validator_store().save()
+        self.telemetry.write_report(path.join(self.session_cache, 'telemetry_poll_stylesheets.json'))
 
-            # Sometimes people make css errors, fix those.
-            if 'background-image' not in emote and 'background' in emote:
-                if re.match(r'^(https?:)?//', emote['background']):
-                    emote['background-image'] = emote['background']
-                    del emote['background']
+        changed = []
+        for subreddit in subreddits:
+            css_subreddit_path = path.join(self.session_cache, subreddit.lower()) + '.css'
+            if not path.exists(css_subreddit_path):
+                if before[subreddit]:
+                    symlink_atomic(os.path.relpath(before[subreddit][0], self.session_cache + '/'), css_subreddit_path)
+                continue
+            if self._stylesheet_version(css_subreddit_path) != before[subreddit]:
+                changed.append(subreddit)
+        return changed
 
-            if("background-size" in emote):
-                logger.warn("background-size found in emote {}. Removing width/height/background-size. See #8. Output possible incorrect.".format(canonical_name(emote)))
-                del emote['width']
-                del emote['height']
-                del emote['background-size']
+    def _stylesheet_version(self, css_subreddit_path):
+        '''The cache file a session stylesheet links to with its modification time and size, None if missing'''
+        try:
+            stat = os.stat(css_subreddit_path)
+        except OSError:
+            return None
+        return (path.realpath(css_subreddit_path), stat.st_mtime, stat.st_size)
 
-            if 'background-image' not in emote:
-                logger.warn('Discarding emotes (does not contain a background-image): {}'.format(emote['names'][0]))
-                validEmote = False
+    def _queue_stylesheet(self, subreddit, batch, deadline):
+        '''Put a download job in batch for the stylesheet of subreddit, unless it is in the session already'''
+        try:
+            css_subreddit_path = path.join(self.session_cache, subreddit.lower()) + '.css'
+            with open(css_subreddit_path, 'r') as f:
+                pass
+        except:
+            url = self._stylesheet_url(subreddit)
+            batch.put(self._create_download_job(url, deadline, self._callback_fetch_stylesheet,
+                                                {'subreddit': subreddit, 'request_url': url}))
 
-            if 'background-position' in emote:
-                for backgroundPosValue in emote['background-position']:
-                    if ',' in backgroundPosValue:
-                        logger.warn('Discarding emotes (Contains illegal "," in background-position css attribute): {}'.format(emote['names'][0]))
-                        validEmote = False
+    def _callback_fetch_stylesheet(self, response, subreddit, request_url):
+        if not response:
+            logger.error("Failed to fetch css for {}".format(subreddit))
+            return
 
-            if 'hover-background-position' in emote:
-                for backgroundPosValue in emote['hover-background-position']:
-                    if ',' in backgroundPosValue:
-                        logger.warn('Discarding emotes (Contains illegal "," in hover-background-position css attribute): {}'.format(emote['names'][0]))
-                        validEmote = False
+        css_subreddit_path = path.join(self.session_cache, subreddit.lower()) + '.css'
 
-            if 'background-image' in emote:
-                if emote['background-image'] in self.image_blacklist:
-                    logger.warn('Discarding emotes (background-image is on blacklist): {}'.format(emote['names'][0]))
-                    validEmote = False
+        if response.status_code == 304:
+            # Not modified, link the stylesheet we already have in the reddit cache.
+            logger.debug("css for {} not modified".format(subreddit))
+            css_cache_file_path = self._validator_store().get_path(request_url)
+            if self.recorder:
+                self.recorder.record(request_url, response, css_cache_file_path)
+            symlink_atomic(os.path.relpath(css_cache_file_path, self.session_cache + '/'), css_subreddit_path)
+            return
 
-            if validEmote:
-                emotes.append(emote)
+        if response.status_code != 200:
+            logger.error("Failed to fetch css for {} (Status {})".format(subreddit, response.status_code))
+            return
 
-        return emotes
+        modified_date_tuple = parsedate(response.headers['Last-Modified'])
+        modified_date_timestamp = calendar.timegm(modified_date_tuple)
+
+        css_url = self._response_url(response)
+        css_cache_file_path = get_file_path(css_url, rootdir=self.reddit_cache )
+        # The stylesheet is decoded while streaming and stored as utf-8.
+        write_response_atomic(response, css_cache_file_path, modified_date_timestamp, decode_unicode=True,
+                              consume_bytes=self._byte_counter(css_url))
+        self._validator_store().update(request_url, response, css_cache_file_path)
+        if self.recorder:
+            self.recorder.record(request_url, response, css_cache_file_path)
+
+        symlink_atomic(os.path.relpath(css_cache_file_path, self.session_cache + '/'), css_subreddit_path)
 
     def _open_fallback_stylesheet(self, fallbacks, subreddit):
         if(len(fallbacks) == 0):
@@ -307,46 +494,111 @@ class RedditEmoteScraper():
                 self._open_fallback_stylesheet(fallbacks, subreddit)
 
 
+    def _load_stylesheet(self, subreddit):
+        '''Returns the emotes in the stylesheet of subreddit'''
+        content, css_subreddit_path = self._read_stylesheet(subreddit)
+        if content is None:
+            return []
+        emotes = process_stylesheet(content, subreddit, self.emote_info, self.nsfw_subreddits, self.image_blacklist,
+                                    self._stylesheet_cache())
+        return self._stylesheet_emotes(subreddit, emotes, css_subreddit_path)
+
+    def _read_stylesheet(self, subreddit):
+        '''Returns the content of subreddit's stylesheet and the path it was read from, None's if there is none'''
+        content = None
+        css_subreddit_path = path.join(self.session_cache, subreddit.lower()) + '.css'
+
+        try:
+            with open( css_subreddit_path, 'r' ) as f:
+                content = f.read().decode('utf-8')
+        except IOError as ex:
+            logger.warn('Could not open stylesheet in session directory for ' + subreddit + ": " + str(ex))
+            if(len(self.css_fallbacks) != 0):
+                try:
+                    (f, css_subreddit_path) = self._open_fallback_stylesheet(list(self.css_fallbacks), subreddit)
+                    with f as f:
+                        content = f.read().decode('utf-8')
+                except NoCSSFoundException as ex:
+                    logger.warn('Could not open stylesheet in fallback directories for ' + subreddit + ": " + str(ex))
+                    content = None;
+
+        return content, css_subreddit_path
+
+    def _stylesheet_emotes(self, subreddit, emotes, css_subreddit_path):
+        if emotes is None:
+            logger.warn('Could not process stylesheet for ' + subreddit + ", it does not contain any emoticons")
+            self._set_rules(subreddit, [])
+            return []
+
+        modified_time = path.getmtime(css_subreddit_path)
+        for emote in emotes:
+            # The emote['last-modified'] is set to the last modify date.
+            # The last-modified http headers are used for this.
+            #
+            # Here we check if CSS file modified date. Image files
+            # are handled at a later stage. (so this value could be over-
+            # written at a later stage)
+            #
+            # A additional operation related to modified date happens
+            # in _read_old_emote(). We set the modify date to the oldest
+            # possible date, as CSS header modify date is not reliable.
+            emote['Last-Modified'] = modified_time
+        self._set_rules(subreddit, emotes)
+        return emotes
+
+    def _set_rules(self, subreddit, emotes):
+        '''Keeps the rule set of subreddit, _record_rules() compares it with the last run'''
+        rules = dict((canonical_name(emote), declarations_hash(emote)) for emote in emotes)
+        with self.mutex:
+            self._emote_rules[subreddit] = rules
+
+    def _describe_changes(self, changes):
+        counts = dict((state, 0) for state in [ADDED, REMOVED, CHANGED, UNCHANGED])
+        for state in changes.itervalues():
+            counts[state] += 1
+        return '{added} added, {removed} removed, {changed} changed, {unchanged} unchanged'.format(**counts)
+
+    def _record_rules(self, subreddits):
+        '''
+        Records the rule sets of subreddits once their emotes are extracted.
+
+        Returns how the rule of every emote changed since the last run.
+        Unchanged emotes are found by the inputs hash of the manifest, which
+        also covers their spritemaps, this only tells the removed emotes.
+        '''
+        manifest = self._emote_manifest()
+        changes = {}
+        for subreddit in subreddits:
+            if subreddit in self._emote_rules:
+                changes.update(diff_rules(manifest.rules(subreddit), self._emote_rules[subreddit]))
+                manifest.record_rules(subreddit, self._emote_rules[subreddit])
+        # Their outputs would be restored if the emote came back, build them again instead.
+        removed = manifest.forget([name for name, state in changes.iteritems() if state == REMOVED])
+        if removed:
+            logger.info("Removed emotes: {}".format(', '.join(sorted(removed))))
+        return changes
+
     def process_stylesheets(self):
         logger.info('Beginning process_stylesheets()')
+        self._emote_rules = {}
 
+        stylesheets = []
         for subreddit in self.subreddits:
-            content = None
-            css_subreddit_path = path.join(self.session_cache, subreddit.lower()) + '.css'
-
-            try:
-                with open( css_subreddit_path, 'r' ) as f:
-                    content = f.read().decode('utf-8')
-            except IOError as ex:
-                logger.warn('Could not open stylesheet in session directory for ' + subreddit + ": " + str(ex))
-                if(len(self.css_fallbacks) != 0):
-                    try:
-                        (f, css_subreddit_path) = self._open_fallback_stylesheet(list(self.css_fallbacks), subreddit)
-                        with f as f:
-                            content = f.read().decode('utf-8')
-                    except NoCSSFoundException as ex:
-                        logger.warn('Could not open stylesheet in fallback directories for ' + subreddit + ": " + str(ex))
-                        content = None;
-
+            content, css_subreddit_path = self._read_stylesheet(subreddit)
             if content is not None:
-                emotes = self._process_stylesheet(content, subreddit)
-                if emotes is not None:
-                    modified_time = path.getmtime(css_subreddit_path)
-                    for emote in emotes:
-                        # The emote['last-modified'] is set to the last modify date.
-                        # The last-modified http headers are used for this.
-                        #
-                        # Here we check if CSS file modified date. Image files
-                        # are handled at a later stage. (so this value could be over-
-                        # written at a later stage)
-                        #
-                        # A additional operation related to modified date happens
-                        # in _read_old_emote(). We set the modify date to the oldest
-                        # possible date, as CSS header modify date is not reliable.
-                        emote['Last-Modified'] = modified_time
-                        self.emotes.append(emote)
-                else:
-                    logger.warn('Could not process stylesheet for ' + subreddit + ", it does not contain any emoticons")
+                stylesheets.append((content, subreddit, css_subreddit_path))
+
+        # Parsing is cpu bound, it runs on a process pool. The results come
+        # back in the order of self.subreddits which decides name precedence.
+        # Stylesheets parsed in an earlier run are taken from the cache.
+        results = process_stylesheets([(css, sr) for css, sr, _ in stylesheets],
+                                      self.emote_info, self.nsfw_subreddits, self.image_blacklist,
+                                      cache=self._stylesheet_cache(),
+                                      processes=self.parse_processes,
+                                      pool=self._process_pool() if self.parse_processes != 1 else None)
+        self._stylesheet_cache().prune()
+        for (content, subreddit, css_subreddit_path), emotes in zip(stylesheets, results):
+            self.emotes.extend(self._stylesheet_emotes(subreddit, emotes, css_subreddit_path))
 
     def _emote_image_source_equal(self, a, b):
         """
@@ -466,6 +718,7 @@ class RedditEmoteScraper():
         # Some people prefer to store web data in code instead of json.
         # This function extracts data from javascript code.
         def get_globals_from_js(javascript, js_var_names):
+            import execjs
 
             ctx = execjs.compile(javascript)
             extracted_vars = {}
@@ -523,53 +776,151 @@ class RedditEmoteScraper():
                 if name in bpm_emotes:
                     emote['tags'] = emote.get('tags', []) + bpm_emotes[name]['tags']
 
+    def verify_cache(self):
+        '''
+        Checks the cached spritemaps of all emotes for truncation and corruption.
+
+        Broken files are removed from the cache, download_images() will download them again.
+        '''
+        logger.info('Beginning verify_cache()')
+        self._verify_cache(self.emotes)
+
+    def _verify_cache(self, emotes, processes=None):
+        manifest = self._emote_manifest()
+        file_paths = set()
+        for emote in emotes:
+            for image_url in [emote['background-image'], emote.get('hover-background-image')]:
+                if image_url:
+                    file_path = get_file_path(image_url, rootdir=self.reddit_cache)
+                    if path.isfile(file_path):
+                        file_paths.add(file_path)
+
+        # A file with the content of a file verified before is fine.
+        unverified = sorted(file_path for file_path in file_paths if not manifest.verified(file_path))
+        processes = processes or self.parse_processes
+        broken = find_broken_images(unverified, processes, self._process_pool() if processes != 1 else None)
+        for file_path in broken:
+            logger.warn("Cached image {} is broken, it will be downloaded again".format(file_path))
+            os.remove(file_path)
+        manifest.set_verified(set(unverified) - set(broken))
+        logger.info("Verified {} of {} cached images, {} broken".format(len(unverified), len(file_paths), len(broken)))
+
     def download_images(self):
         logger.info('Beginning download_images()')
-        logger.debug("Downloading images using {} threads".format(self.workers))
-        workpool = WorkerPool(size=self.workers)
+        self._fetch_engine()
+        self.telemetry.reset()
+        logger.debug("Downloading images using {} concurrent requests".format(self.concurrency.limit))
 
-        def create_download_jobs(key_func):
-            for image_url, group in itertools.groupby(sorted(self.emotes, key=key_func), key_func):
-                if not image_url:
-                    continue
-
-                file_path = get_file_path(image_url, rootdir=self.reddit_cache)
-                if not path.isfile(file_path):
-                    workpool.put(DownloadJob(self._requests,
-                                             urlparse.urljoin('https://s3.amazonaws.com/',image_url),
-                                             retry=5,
-                                             rate_limit_lock=self.rate_limit_lock,
-                                             callback=self._callback_download_image,
-                                             **{'image_path': file_path}))
+        # The journal of an earlier (crashed) run in this session tells which
+        # downloads were still pending and how often downloads failed before.
+        journal = DownloadJournal(path.join(self.session_cache, 'download_journal.log'))
+        history = journal.load()
+        pending = self._pending_downloads(journal, history)
 
         with self.mutex:
-            create_download_jobs( lambda e: e['background-image'])
-            create_download_jobs( lambda e: e.get('hover-background-image'))
+            emotes = list(self.emotes)
+        self._download_images(emotes, journal, history, pending, self._stage_deadline())
+        journal.close()
+        self._validator_store().save()
+        self.telemetry.write_report(path.join(self.session_cache, 'telemetry_download_images.json'))
+
+    def _pending_downloads(self, journal, history):
+        '''The downloads the journal has as pending that are not in the cache yet'''
+        pending = {}
+        for url, download in journal.pending(history).iteritems():
+            if path.isfile(download['path']):
+                # Done by another scraper, or the crash came after the file was written.
+                journal.record(COMPLETED, url, path=download['path'])
+            else:
+                pending[url] = download
+        if pending:
+            logger.info("Resuming {} pending downloads from the journal".format(len(pending)))
+        return pending
+
+    def _download_images(self, emotes, journal, history, pending, deadline):
+        '''Download the spritemaps of emotes and the pending downloads, returns when they are all in the cache'''
+        batch = self._fetch_engine().batch()
+
+        # The number of emotes depending on every spritemap, base and hover images alike.
+        # Keyed on the cache file, different spellings of the same url are one download.
+        dependents = {}
+        for emote in emotes:
+            for image_url in set([emote['background-image'], emote.get('hover-background-image')]):
+                if image_url:
+                    file_path = get_file_path(image_url, rootdir=self.reddit_cache)
+                    dependents.setdefault(file_path, [0, image_url])[0] += 1
+
+        for url, download in pending.iteritems():
+            dependents.setdefault(download['path'], [0, url])
+
+        downloads = []
+        waits = []
+        for file_path, (count, image_url) in dependents.iteritems():
+            url = urlparse.urljoin('https://s3.amazonaws.com/', image_url)
+            # Spritemap urls are content addressed. A file in the cache is
+            # never re-validated, the validators are used when it is re-fetched.
+            if path.isfile(file_path):
+                if self.recorder:
+                    self.recorder.record_file(url, file_path)
+                continue
+            if not self._in_flight.claim(file_path):
+                # Someone else is already downloading this file.
+                waits.append(file_path)
+                continue
+            failures = history.get(url, {}).get('failures', 0)
+            if failures >= self.max_download_failures:
+                logger.warn("Not downloading {}, it failed permanently {} times before".format(url, failures))
+                self._in_flight.release(file_path)
+                continue
+            downloads.append((count, url, file_path, failures))
+
+        # Spritemaps most emotes depend on are downloaded first.
+        callback = functools.partial(self._callback_download_image, journal=journal)
+        for count, url, file_path, failures in downloads:
+            journal.record(QUEUED, url, path=file_path)
+            # Every earlier failure costs a retry, so known bad urls do not hold up the phase.
+            batch.put(self._create_download_job(url, deadline, callback,
+                                                {'image_path': file_path, 'request_url': url},
+                                                retry=max(1, 5 - failures), journal=journal),
+                      priority=count)
+
+        batch.join()
+        for file_path in waits:
+            self._in_flight.wait(file_path)
+
+    def _callback_download_image(self, response, image_path, request_url, journal):
+        size = None
+        try:
+            size = self._store_image(response, image_path, request_url)
+        finally:
+            if size is None:
+                journal.record(FAILED, request_url, path=image_path, status=response.status_code if response is not None else None)
+            else:
+                journal.record(COMPLETED, request_url, path=image_path, bytes=size)
+            self._in_flight.release(image_path)
 
-        workpool.shutdown()
-        workpool.join()
+    def _store_image(self, response, image_path, request_url):
+        '''Returns the number of bytes written or None if the download failed'''
+        if response is None:
+            logger.error("Failed to fetch image at {}".format(request_url))
+            return None
 
-    def _callback_download_image(self, response, image_path):
+        if response.status_code == 304:
+            return 0
 
         if response.status_code != 200:
-            logger.error("Failed to fetch image at {} (Status {})".format(response.url, response.status_code))
-            return
-
-        data = response.content
-
-        image_dir = path.dirname(image_path)
+            logger.error("Failed to fetch image at {} (Status {})".format(request_url, response.status_code))
+            return None
 
         modified_date_tuple = parsedate(response.headers['Last-Modified'])
         modified_date_timestamp = calendar.timegm(modified_date_tuple)
 
-        with self.mutex:
-            if not path.exists(image_dir):
-                os.makedirs(image_dir)
-
-        with open(image_path, 'wb') as f:
-            f.write(data)
-
-        utime(image_path, (time.time(), modified_date_timestamp))
+        size = write_response_atomic(response, image_path, modified_date_timestamp,
+                                     consume_bytes=self._byte_counter(request_url))
+        self._validator_store().update(request_url, response, image_path)
+        if self.recorder:
+            self.recorder.record(request_url, response, image_path)
+        return size
 
     def _explode_emote(self, emote, background_image_path, hover):
         '''
@@ -582,9 +933,9 @@ class RedditEmoteScraper():
 
         Does not handle hover images.
         '''
+        from PIL import Image
         explode_dir = get_explode_directory(self.output_dir, emote, hover)
-        if not os.path.exists(explode_dir):
-            os.makedirs(explode_dir)
+        makedirs(explode_dir)
         shutil.copyfile(background_image_path, os.path.join(explode_dir, "background.png"))
         apngasm('--force', '-D', os.path.join(explode_dir, "background.png"), "-o", explode_dir, '-j', '-x')
         os.remove(os.path.join(explode_dir, "background.png"))
@@ -615,6 +966,7 @@ class RedditEmoteScraper():
         '''
         Reconstructs a emote from a exploded form to animated .png
         '''
+        from lxml import etree
         explode_dir = get_explode_directory(self.output_dir, emote, hover)
         animation_file = os.path.join(explode_dir, 'animation.xml')
         with open(animation_file, 'r') as f:
@@ -638,8 +990,7 @@ class RedditEmoteScraper():
     def _handle_background_for_emote(self, emote, background_image_path, background_image):
         extracted_single_image = extract_single_image(emote, background_image)
 
-        if not os.path.exists(os.path.dirname(get_single_image_path(self.output_dir, emote))):
-            os.makedirs(os.path.dirname(get_single_image_path(self.output_dir, emote)))
+        makedirs(os.path.dirname(get_single_image_path(self.output_dir, emote)))
 
         if emote['base_img_animation']:
             same_as_spritemap = self._explode_emote(emote, background_image_path, hover=False)
@@ -683,7 +1034,19 @@ class RedditEmoteScraper():
 
         return same_as_spritemap
 
+    def _drop_emotes_without_spritemaps(self, emotes):
+        '''Returns the emotes whose spritemaps are in the cache, the others failed to download'''
+        found = []
+        for emote in emotes:
+            missing = [spritemap_path for spritemap_path in self._spritemap_paths(emote) if not path.isfile(spritemap_path)]
+            if missing:
+                logger.warn("Skipping emote {}, spritemap {} is missing".format(canonical_name(emote), missing[0]))
+            else:
+                found.append(emote)
+        return found
+
     def _extract_images_from_spritemaps(self, emotes):
+        from PIL import Image
 
         def is_apng(image_data):
             return 'acTL' in image_data[0:image_data.find('IDAT')]
@@ -737,13 +1100,83 @@ class RedditEmoteScraper():
                     emote['Last-Modified'] = modified_time
             hover_background_image.close()
 
+    def _spritemap_paths(self, emote):
+        paths = []
+        for key in ['background-image', 'hover-background-image']:
+            if emote.get(key):
+                paths.append(path.realpath(get_file_path(emote[key], rootdir=self.reddit_cache)))
+        return paths
+
+    def _emote_outputs_exist(self, emote):
+        if not path.isfile(get_single_image_path(self.output_dir, emote)):
+            return False
+        if emote.get('base_img_animation') and not path.isdir(get_explode_directory(self.output_dir, emote, hover=False)):
+            return False
+        if has_hover(emote):
+            if not path.isfile(get_single_hover_image_path(self.output_dir, emote)):
+                return False
+            if emote.get('hover_img_animation') and not path.isdir(get_explode_directory(self.output_dir, emote, hover=True)):
+                return False
+        return True
+
+    def _restore_emote(self, emote, outputs):
+        '''Apply the outputs recorded in the manifest to emote if its images still exist'''
+        restored = dict((k, v) for k, v in emote.iteritems() if k not in OUTPUT_KEYS)
+        restored.update(outputs)
+        if not self._emote_outputs_exist(restored):
+            return False
+        emote.clear()
+        emote.update(restored)
+        for spritemap_path in self._spritemap_paths(emote):
+            emote['Last-Modified'] = max(emote['Last-Modified'], path.getmtime(spritemap_path))
+        return True
+
+    def _restore_unchanged_emotes(self, emotes):
+        '''Restores the emotes whose inputs did not change from the manifest, returns the changed emotes'''
+        manifest = self._emote_manifest()
+        changed_emotes = []
+        for emote in emotes:
+            inputs = manifest.inputs_hash(emote, self._spritemap_paths(emote))
+            self._emote_inputs[canonical_name(emote)] = inputs
+            outputs = manifest.outputs(emote, inputs)
+            if outputs is not None and self._restore_emote(emote, outputs):
+                self._unchanged_emotes.add(canonical_name(emote))
+            else:
+                changed_emotes.append(emote)
+        return changed_emotes
+
+    def _record_emotes(self, emotes):
+        '''Records what the (changed) emotes were built from and to in the manifest'''
+        manifest = self._emote_manifest()
+        for emote in emotes:
+            if canonical_name(emote) not in self._unchanged_emotes:
+                manifest.record(emote, self._emote_inputs.get(canonical_name(emote)))
+
+    def _save_manifest(self):
+        manifest = self._emote_manifest()
+        manifest.prune((canonical_name(emote) for emote in self.emotes), self.subreddits)
+        manifest.save()
+
     def extract_images_from_spritemaps(self):
         logger.info('Beginning extract_images_from_spritemaps()')
-        self._extract_images_from_spritemaps(self.emotes)
+        self._emote_inputs = {}
+        self._unchanged_emotes = set()
+        self.emotes = self._drop_emotes_without_spritemaps(self.emotes)
+        changed_emotes = self._restore_unchanged_emotes(self.emotes)
+        logger.info('{} of {} emotes are unchanged since the last run'.format(len(self._unchanged_emotes), len(self.emotes)))
+        self._extract_images_from_spritemaps(changed_emotes)
 
     def cropEmotes(self):
         logger.info('Beginning cropEmotes()')
-        for emote in self.emotes:
+        self._crop_emotes([emote for emote in self.emotes if canonical_name(emote) not in self._unchanged_emotes])
+        self._record_emotes(self.emotes)
+        changes = self._record_rules(self.subreddits)
+        logger.info('Emote rules since the last run: {}'.format(self._describe_changes(changes)))
+        self._save_manifest()
+
+    def _crop_emotes(self, emotes):
+        from PIL import Image
+        for emote in emotes:
             base_path = get_single_image_path(self.output_dir, emote)
             if not has_hover(emote):
                 if(emote['base_img_animation']):
@@ -807,8 +1240,7 @@ class RedditEmoteScraper():
         It will create self.old_emotes or set it to None.
         """
         logger.info('Beginning read_old_emotes()')
-        # XXX: Filename is defined in two locations now. Here and one level higher in scrape.py.
-        FILENAME = path.join(self.output_dir, 'emotes_metadata')
+        FILENAME = self._metadata_filename()
 
         old_emotes = None
         try:
@@ -874,6 +1306,7 @@ class RedditEmoteScraper():
 
     def visually_dedupe_emotes(self):
         logger.info('Beginning visually_dedupe_emotes()')
+        import pypuzzle
         processed_emotes = []
         duplicates = []
         puzzle = pypuzzle.Puzzle()
@@ -881,6 +1314,7 @@ class RedditEmoteScraper():
         # These images where merged with other images who also got a generic vector.
         # Setting noise cutoff fixed this.
         puzzle.set_noise_cutoff(0)
+        manifest = self._emote_manifest()
 
         for subreddit in self.subreddits:
             subreddit_emotes = [x for x in self.emotes if x['sr'] == subreddit]
@@ -896,9 +1330,16 @@ class RedditEmoteScraper():
                 if emote['base_img_animation'] or (has_hover(emote) and emote['hover_img_animation']):
                     continue
 
-                image_path = get_single_image_path(self.output_dir, emote)
-                logger.debug('puzzle.get_cvec_from_file('+image_path+')')
-                vector = puzzle.get_cvec_from_file(image_path)
+                # The vector of an unchanged emote is read from the manifest
+                compressed_vector = manifest.vector(emote)
+                if compressed_vector is not None and canonical_name(emote) in self._unchanged_emotes:
+                    vector = puzzle.uncompress_cvec(compressed_vector)
+                else:
+                    image_path = get_single_image_path(self.output_dir, emote)
+                    logger.debug('puzzle.get_cvec_from_file('+image_path+')')
+                    vector = puzzle.get_cvec_from_file(image_path)
+                    compressed_vector = puzzle.compress_cvec(vector)
+                    manifest.set_vector(emote, compressed_vector)
 
                 for other_emote, other_compressed_vector in processed_emotes:
                     other_vector = puzzle.uncompress_cvec(other_compressed_vector)
@@ -913,9 +1354,10 @@ class RedditEmoteScraper():
                         # Images are equal! Lets merge them.
                         self._merge_emotes(other_emote, emote)
                         duplicates.append(emote)
-                processed_emotes.append((emote, puzzle.compress_cvec(vector)))
+                processed_emotes.append((emote, compressed_vector))
 
         self.emotes = [emote for emote in self.emotes if emote not in duplicates]
+        manifest.save()
 
     def emote_post_preferance(self):
         logger.info('Beginning emote_post_preferance()')
@@ -951,5 +1393,363 @@ class RedditEmoteScraper():
                 if '' in emote['tags']:
                     emote['tags'].remove('')
 
+    def stream_subreddits(self, download_css=True, verify_cache=False, shard=None):
+        '''
+        Streaming replacement of fetch_css() up to cropEmotes().
+
+        Every subreddit is fetched, parsed and has its spritemaps downloaded on
+        its own, and is extracted as soon as that is done. The extraction
+        queue holds at most stream_window subreddits, the subreddit workers
+        wait while it is full. dedupe_emotes() and the later steps run on the
+        complete set of emotes afterwards.
+
+        With shard (index, count) only the subreddits of that shard are
+        handled and the result is saved for merge_shards().
+        '''
+        logger.info('Beginning stream_subreddits()')
+        subreddits = self.subreddits
+        telemetry_name = 'telemetry_stream_subreddits.json'
+        if shard is not None:
+            subreddits = self._shard_subreddits(*shard)
+            telemetry_name = 'telemetry_stream_subreddits.shard-{}-of-{}.json'.format(*shard)
+        self._emote_inputs = {}
+        self._unchanged_emotes = set()
+        self._emote_rules = {}
+
+        emotes_by_subreddit = self._stream(subreddits, download_css, verify_cache, telemetry_name)
+
+        # The emotes are kept in subreddit order, like process_stylesheets() does.
+        self.emotes = [emote for subreddit in subreddits for emote in emotes_by_subreddit.get(subreddit, [])]
+        logger.info('{} of {} emotes are unchanged since the last run'.format(len(self._unchanged_emotes), len(self.emotes)))
+        if shard is None:
+            self._save_manifest()
+        else:
+            # The manifest is shared by all shards, merge_shards() saves it.
+            self._save_shard(shard, emotes_by_subreddit)
+
+    def _stream(self, subreddits, download_css, verify_cache, telemetry_name):
+        '''
+        Streams subreddits up to cropping (see stream_subreddits()), returns their emotes by subreddit
+
+        A subreddit that failed is logged and left out of the result.
+        '''
+        engine = self._fetch_engine()
+        self.telemetry.reset()
+        if download_css and self.nsfw_subreddits:
+            self._prime_over18()
+        deadline = self._stage_deadline()
+
+        journal = DownloadJournal(path.join(self.session_cache, 'download_journal.log'))
+        history = journal.load()
+        pending = self._pending_downloads(journal, history)
+
+        subreddit_queue = Queue()
+        for subreddit in subreddits:
+            subreddit_queue.put(subreddit)
+        extract_queue = Queue(maxsize=self.stream_window)
+        stop = threading.Event()
+
+        def resume_pending():
+            try:
+                self._download_images([], journal, history, pending, deadline)
+            except Exception, e:
+                logger.exception(e)
+
+        def fetch_and_download():
+            while not stop.is_set():
+                try:
+                    subreddit = subreddit_queue.get_nowait()
+                except Empty:
+                    return
+                emotes = None
+                try:
+                    if download_css:
+                        batch = engine.batch()
+                        self._queue_stylesheet(subreddit, batch, deadline)
+                        batch.join()
+                    emotes = self._load_stylesheet(subreddit)
+                    if verify_cache:
+                        # Forking a pool next to the running threads can deadlock it, and a
+                        # pool per subreddit costs more than it saves. The workers verify in parallel.
+                        self._verify_cache(emotes, processes=1)
+                    self._download_images(emotes, journal, history, {}, deadline)
+                except Exception, e:
+                    logger.exception(e)
+                extract_queue.put((subreddit, emotes))
+
+        workers = []
+        if pending:
+            workers.append(threading.Thread(target=resume_pending, name='StreamResume'))
+        for i in range(min(self.stream_window, len(subreddits))):
+            workers.append(threading.Thread(target=fetch_and_download, name='StreamWorker-{}'.format(i)))
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        emotes_by_subreddit = {}
+        try:
+            for i in range(len(subreddits)):
+                subreddit, emotes = extract_queue.get()
+                if emotes is None:
+                    continue  # Fetching or downloading failed, it was logged.
+                try:
+                    emotes = self._drop_emotes_without_spritemaps(emotes)
+                    changed_emotes = self._restore_unchanged_emotes(emotes)
+                    self._extract_images_from_spritemaps(changed_emotes)
+                    self._crop_emotes(changed_emotes)
+                except Exception:
+                    # A spritemap PIL can not read fails this subreddit, not the others.
+                    logger.exception("Extracting the emotes of {} failed".format(subreddit))
+                    continue
+                self._record_emotes(changed_emotes)
+                changes = self._record_rules([subreddit])
+                logger.debug('Emote rules of {} since the last run: {}'.format(subreddit, self._describe_changes(changes)))
+                emotes_by_subreddit[subreddit] = emotes
+                logger.debug("Extracted {} of {} emotes of {}".format(len(changed_emotes), len(emotes), subreddit))
+        finally:
+            # If extracting failed the workers take no new subreddits, the ones
+            # waiting for room in the extraction queue are let through.
+            stop.set()
+            for worker in workers:
+                while worker.is_alive():
+                    try:
+                        extract_queue.get_nowait()
+                    except Empty:
+                        pass
+                    worker.join(0.1)
+            journal.close()
+            self._validator_store().save()
+            self.telemetry.write_report(path.join(self.session_cache, telemetry_name))
+        return emotes_by_subreddit
+
+    def _shard_subreddits(self, index, count):
+        '''The subreddits of shard index (counting from 0) of count'''
+        return self.subreddits[index::count]
+
+    def _shard_path(self, index, count):
+        return path.join(self.session_cache, 'shards', 'shard-{}-of-{}.pickle'.format(index, count))
+
+    def _save_shard(self, shard, emotes_by_subreddit):
+        state = {
+            'subreddits': self._shard_subreddits(*shard),
+            'emotes_by_subreddit': emotes_by_subreddit,
+            'emote_inputs': self._emote_inputs,
+            'unchanged_emotes': self._unchanged_emotes,
+            'emote_rules': self._emote_rules,
+            'files': self._emote_manifest().used_files(),
+        }
+        shard_path = self._shard_path(*shard)
+        write_atomic(shard_path, [pickle.dumps(state, pickle.HIGHEST_PROTOCOL)])
+        logger.info("Saved shard {} of {} to {}".format(shard[0], shard[1], shard_path))
+
+    def merge_shards(self, count):
+        '''
+        Combines the results of the count shards into the state stream_subreddits() leaves.
+
+        The emotes are put in the order of self.subreddits, so dedupe_emotes()
+        and the later stages give the same result as a single process.
+        '''
+        logger.info('Beginning merge_shards()')
+        manifest = self._emote_manifest()
+        emotes_by_subreddit = {}
+        self._emote_inputs = {}
+        self._unchanged_emotes = set()
+        self._emote_rules = {}
+        for index in range(count):
+            shard_path = self._shard_path(index, count)
+            try:
+                with open(shard_path, 'rb') as f:
+                    state = pickle.load(f)
+            except IOError as ex:
+                raise ShardMergeException("Shard {} of {} is missing: {}".format(index, count, ex))
+            if state['subreddits'] != self._shard_subreddits(index, count):
+                raise ShardMergeException("Shard {} of {} was made for other subreddits".format(index, count))
+            emotes_by_subreddit.update(state['emotes_by_subreddit'])
+            self._emote_inputs.update(state['emote_inputs'])
+            self._unchanged_emotes.update(state['unchanged_emotes'])
+            self._emote_rules.update(state['emote_rules'])
+            manifest.add_files(state['files'])
+
+        self.emotes = [emote for subreddit in self.subreddits for emote in emotes_by_subreddit.get(subreddit, [])]
+        self._record_emotes(self.emotes)
+        changes = self._record_rules(self.subreddits)
+        logger.info('Emote rules since the last run: {}'.format(self._describe_changes(changes)))
+        self._save_manifest()
+
+    def stages(self, download_css=True, berrytube_tags=True, bpm_tags=True, verify_cache=False, stream=False,
+               shard=None, merge_shards=None, collect=None):
+        '''
+        The scrape pipeline, every stage declared with the stages it reads the results of.
+
+        The tag downloads overlap with the stylesheet download, adding tags
+        overlaps with the image download. With stream, stream_subreddits()
+        replaces the stages from fetch_css up to cropEmotes.
+
+        A shard (index, count) only streams its part of the subreddits.
+        merge_shards (the number of shards) replaces stream_subreddits with
+        merging the saved shards. collect replaces it with a function that
+        sets self.emotes to extracted emotes, like the daemon keeps them.
+        '''
+        if shard is not None:
+            return [Stage('stream_subreddits', functools.partial(self.stream_subreddits, download_css, verify_cache, shard))]
+
+        stages = [
+            Stage('download_bt_v2_tags', self.download_bt_v2_tags if berrytube_tags else None),
+            Stage('download_bpm_tags', self.download_bpm_tags if bpm_tags else None),
+        ]
+        if merge_shards:
+            stages += [
+                Stage('merge_shards', functools.partial(self.merge_shards, merge_shards)),
+                Stage('dedupe_emotes', self.dedupe_emotes, ['merge_shards']),
+            ]
+        elif collect is not None:
+            stages += [
+                Stage('collect_emotes', collect),
+                Stage('dedupe_emotes', self.dedupe_emotes, ['collect_emotes']),
+            ]
+        elif stream:
+            stages += [
+                Stage('stream_subreddits', functools.partial(self.stream_subreddits, download_css, verify_cache)),
+                Stage('dedupe_emotes', self.dedupe_emotes, ['stream_subreddits']),
+            ]
+        else:
+            stages += [
+                Stage('fetch_css', self.fetch_css if download_css else None),
+                Stage('process_stylesheets', self.process_stylesheets, ['fetch_css']),
+                Stage('dedupe_emotes', self.dedupe_emotes, ['process_stylesheets']),
+            ]
+        stages += [
+            # The tag stages all extend emote['tags'], they run one after another.
+            Stage('add_bt_tags', self.add_bt_tags, ['dedupe_emotes']),
+            Stage('add_bt_v2_tags', self.add_bt_v2_tags, ['add_bt_tags', 'download_bt_v2_tags']),
+            Stage('add_bpm_tags', self.add_bpm_tags, ['add_bt_v2_tags', 'download_bpm_tags']),
+        ]
+        if stream or merge_shards or collect is not None:
+            images_done = 'add_bpm_tags'
+        else:
+            stages += [
+                Stage('verify_cache', self.verify_cache if verify_cache else None, ['dedupe_emotes']),
+                Stage('download_images', self.download_images, ['verify_cache']),
+                Stage('extract_images_from_spritemaps', self.extract_images_from_spritemaps, ['download_images', 'add_bpm_tags']),
+                Stage('cropEmotes', self.cropEmotes, ['extract_images_from_spritemaps']),
+            ]
+            images_done = 'cropEmotes'
+        return stages + [
+            # This stage will read the old emotes. It sets the modified date.
+            Stage('read_old_emotes', self.read_old_emotes, [images_done]),
+            Stage('remove_broken_emotes', self.remove_broken_emotes, ['read_old_emotes']),
+            Stage('visually_dedupe_emotes', self.visually_dedupe_emotes, ['remove_broken_emotes']),
+            Stage('emote_post_preferance', self.emote_post_preferance, ['visually_dedupe_emotes']),
+            Stage('remove_garbage', self.remove_garbage, ['emote_post_preferance']),
+        ]
+
+    def _checkpoint_dir(self, shard=None):
+        directory = path.join(self.session_cache, 'checkpoints')
+        if shard is not None:
+            # Shards share the session cache, every shard has its own checkpoints.
+            directory = path.join(directory, 'shard-{}-of-{}'.format(*shard))
+        return directory
+
+    def _save_checkpoint(self, checkpoint_dir, stage_names, done):
+        '''
+        Saves the state as the checkpoint before the next stage in stage_names.
+
+        Only done when the finished stages are exactly the stages declared
+        before that stage, otherwise resuming at it would leave stages out
+        or run them twice.
+        '''
+        count = len(done)
+        if count >= len(stage_names) or set(stage_names[:count]) != done:
+            return
+        state = {
+            'emotes': self.emotes,
+            'old_emotes': self.old_emotes,
+            'emote_inputs': self._emote_inputs,
+            'unchanged_emotes': self._unchanged_emotes,
+            'emote_rules': self._emote_rules,
+        }
+        checkpoint_path = path.join(checkpoint_dir, stage_names[count] + '.pickle')
+        write_atomic(checkpoint_path, [pickle.dumps(state, pickle.HIGHEST_PROTOCOL)])
+        logger.debug("Saved checkpoint {}".format(checkpoint_path))
+
+    def _load_checkpoint(self, checkpoint_dir, stage_name):
+        checkpoint_path = path.join(checkpoint_dir, stage_name + '.pickle')
+        try:
+            with open(checkpoint_path, 'rb') as f:
+                state = pickle.load(f)
+        except IOError as ex:
+            raise NoCheckpointException("No checkpoint to resume at stage {}: {}".format(stage_name, ex))
+        self.emotes = state['emotes']
+        self.old_emotes = state['old_emotes']
+        self._emote_inputs = state['emote_inputs']
+        self._unchanged_emotes = state['unchanged_emotes']
+        self._emote_rules = state['emote_rules']
+        logger.info("Resuming at stage {} from {}".format(stage_name, checkpoint_path))
+
+    def scrape(self, from_stage=None, to_stage=None, **options):
+        '''
+        Run the pipeline of stages(**options), independent stages at the same
+        time unless checkpoints are saved.
+
+        from_stage resumes at that stage with the state of its checkpoint,
+        to_stage stops after that stage. A run from the first stage removes
+        the checkpoints of earlier runs. Returns True if the emotes are
+        complete: the last stage ran and this was not a shard.
+        '''
+        stages = self.stages(**options)
+        stage_names = [stage.name for stage in stages]
+        for name in [from_stage, to_stage]:
+            if name is not None and name not in stage_names:
+                raise UnknownStageException("Unknown stage {}, the stages are: {}".format(name, ', '.join(stage_names)))
+
+        first = stage_names.index(from_stage) if from_stage else 0
+        last = stage_names.index(to_stage) if to_stage else len(stages) - 1
+        checkpoint_dir = self._checkpoint_dir(options.get('shard'))
+        if first:
+            self._load_checkpoint(checkpoint_dir, from_stage)
+        elif self.checkpoints:
+            for checkpoint_path in glob(path.join(checkpoint_dir, '*.pickle')):
+                os.remove(checkpoint_path)
+        for i, stage in enumerate(stages):
+            if i < first or i > last:
+                stage.function = None
+
+        if self.parse_processes != 1 and any(stage.function is not None and stage.name in ('process_stylesheets', 'verify_cache')
+                                             for stage in stages):
+            # Fork the workers while this is the only thread.
+            self._process_pool()
+
+        checkpoint = None
+        if self.checkpoints:
+            checkpoint = functools.partial(self._save_checkpoint, checkpoint_dir, stage_names)
+        durations = self._stage_executor().run(stages, checkpoint)
+        for name, seconds in sorted(durations.iteritems(), key=lambda d: -d[1]):
+            logger.debug("Stage {} took {:.1f}s".format(name, seconds))
+        return last == len(stages) - 1 and options.get('shard') is None
+
+    def _metadata_filename(self):
+        return path.join(self.output_dir, 'emotes_metadata')
+
     def export_emotes(self):
         return self.emotes
+
+    def write_emotes_metadata(self):
+        '''Writes the exported emotes as (minified) json and javascript, read_old_emotes() reads them back'''
+        emotes = self.export_emotes()
+        FILENAME = self._metadata_filename()
+
+        with open(FILENAME + '.min.js', 'w') as f:
+            f.write("var emotes_metadata = ")
+            json.dump(emotes, fp=f, separators=(',', ':'), sort_keys=True)
+            f.write(";")
+
+        with open(FILENAME + '.js', 'w') as f:
+            f.write("var emotes_metadata = ")
+            json.dump(emotes, fp=f, separators=(',', ':'), sort_keys=True, indent=2)
+            f.write(";")
+
+        with open(FILENAME + '.min.json', 'w') as f:
+            json.dump(emotes, fp=f, separators=(',', ':'), sort_keys=True)
+
+        with open(FILENAME + '.json', 'w') as f:
+            json.dump(emotes, fp=f, separators=(',', ':'), sort_keys=True, indent=2)
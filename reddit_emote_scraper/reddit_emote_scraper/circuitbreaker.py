@@ -0,0 +1,78 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Lock
+from time import time
+import urlparse
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Circuit(object):
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+
+class CircuitBreaker(object):
+    """
+    Per host circuit breaker.
+
+    After failure_threshold consecutive failures (connection errors, timeouts
+    and 5xx responses) a host is considered down and requests to it fail
+    immediately. After reset_seconds one trial request is let through, if it
+    succeeds the host is closed again, if it fails it stays open.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=60):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = Lock()
+        self._circuits = {}
+
+    def _circuit(self, url):
+        host = urlparse.urlparse(url).hostname
+        if host not in self._circuits:
+            self._circuits[host] = _Circuit()
+        return self._circuits[host]
+
+    def allow(self, url):
+        '''Returns False if requests to the host of url should fail fast'''
+        with self.lock:
+            circuit = self._circuit(url)
+            if circuit.opened_at is None:
+                return True
+            if time() - circuit.opened_at < self.reset_seconds or circuit.trial_running:
+                return False
+            circuit.trial_running = True
+            return True
+
+    def record_success(self, url):
+        with self.lock:
+            circuit = self._circuit(url)
+            if circuit.opened_at is not None:
+                logger.info("Host of {} is reachable again, closing circuit".format(url))
+            circuit.failures = 0
+            circuit.opened_at = None
+            circuit.trial_running = False
+
+    def record_failure(self, url):
+        with self.lock:
+            circuit = self._circuit(url)
+            circuit.failures += 1
+            if circuit.trial_running or (circuit.opened_at is None and circuit.failures >= self.failure_threshold):
+                logger.warn("Host of {} failed {} times in a row, opening circuit".format(url, circuit.failures))
+                circuit.opened_at = time()
+            circuit.trial_running = False
@@ -0,0 +1,94 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Lock
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyController(object):
+    """
+    Decides how many requests may be in flight.
+
+    Responses are collected in windows of `window` responses. At the end of
+    every window the limit is adjusted once:
+
+    - More than 5% throttled (429/503) responses: multiplicative decrease.
+    - Median latency more than twice the baseline: decrease by one.
+    - Otherwise, if no job had to wait for the rate limiter (more requests
+      would only wait longer) and latency is near the baseline: increase.
+
+    Until the first decrease the increase is multiplicative (slow start), so a
+    cold cache run quickly ramps up to what the hosts allow. Afterwards it is
+    additive. Adjusting once per window keeps the limit from thrashing.
+    """
+
+    def __init__(self, initial=20, minimum=2, maximum=50, window=20):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.limit = max(minimum, min(maximum, initial))
+        self.lock = Lock()
+
+        self._latencies = []
+        self._throttled = 0
+        self._rate_limited = 0
+        self._baseline = None
+        self._slow_start = True
+
+    def record_response(self, latency, status_code):
+        with self.lock:
+            self._latencies.append(latency)
+            if status_code in (429, 503):
+                self._throttled += 1
+            if len(self._latencies) >= self.window:
+                self._adjust()
+
+    def record_rate_limited(self):
+        '''A job had to wait for its rate limit budget'''
+        with self.lock:
+            self._rate_limited += 1
+
+    def _adjust(self):
+        samples = len(self._latencies)
+        latency = sorted(self._latencies)[samples // 2]
+
+        # The baseline follows the lowest latency seen, but may creep up slowly
+        # so a permanently slower network is not seen as congestion forever.
+        if self._baseline is None:
+            self._baseline = latency
+        else:
+            self._baseline = min(latency, self._baseline * 1.1)
+
+        old_limit = self.limit
+        if self._throttled > samples * 0.05:
+            self.limit = int(self.limit * 0.75)
+            self._slow_start = False
+        elif latency > 2 * self._baseline:
+            self.limit -= 1
+            self._slow_start = False
+        elif not self._rate_limited and latency < 1.5 * self._baseline:
+            if self._slow_start:
+                self.limit = int(self.limit * 1.5) + 1
+            else:
+                self.limit += 1
+        self.limit = max(self.minimum, min(self.maximum, self.limit))
+
+        if self.limit != old_limit:
+            logger.debug("Concurrency {} -> {} (median latency {:.2f}s, {} throttled, {} rate limited)".format(
+                old_limit, self.limit, latency, self._throttled, self._rate_limited))
+
+        self._latencies = []
+        self._throttled = 0
+        self._rate_limited = 0
@@ -0,0 +1,231 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+
+from time import time, sleep
+import copy
+import json
+import os
+
+from .downloadjournal import DownloadJournal
+from .fileutils import write_atomic
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PollSchedule(object):
+    """
+    Learns how often every subreddit's stylesheet should be polled.
+
+    A poll that found a change halves the subreddit's interval, one that found
+    none makes it half again as long, always between min_interval and
+    max_interval. Subreddits that change their stylesheet often are polled
+    often, quiet ones about once per max_interval. The schedule is saved so a
+    restarted daemon keeps what it learned.
+    """
+
+    def __init__(self, filename, min_interval, max_interval):
+        self.filename = filename
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._entries = {}
+        try:
+            with open(filename, 'r') as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError) as ex:
+            logger.debug("Could not read poll schedule {}: {}".format(filename, ex))
+
+    def _entry(self, subreddit):
+        key = subreddit.lower()
+        if key not in self._entries:
+            self._entries[key] = {'interval': self.min_interval, 'next_poll': 0, 'polls': 0, 'changes': 0}
+        return self._entries[key]
+
+    def due(self, subreddits, now):
+        '''The subreddits that should be polled at time now'''
+        return [subreddit for subreddit in subreddits if self._entry(subreddit)['next_poll'] <= now]
+
+    def next_poll(self, subreddits):
+        '''Time of the earliest poll of subreddits'''
+        return min(self._entry(subreddit)['next_poll'] for subreddit in subreddits)
+
+    def record(self, subreddit, changed, now):
+        '''Record a poll of subreddit at time now, changed if its stylesheet changed'''
+        entry = self._entry(subreddit)
+        entry['polls'] += 1
+        if changed:
+            entry['changes'] += 1
+            entry['last_change'] = now
+            interval = entry['interval'] / 2.0
+        else:
+            interval = entry['interval'] * 1.5
+        entry['interval'] = max(self.min_interval, min(self.max_interval, interval))
+        entry['next_poll'] = now + entry['interval']
+
+    def schedule_next(self, subreddit, now):
+        '''Schedule the next poll of subreddit one interval after now, without recording a poll'''
+        entry = self._entry(subreddit)
+        entry['next_poll'] = now + entry['interval']
+
+    def save(self):
+        write_atomic(self.filename, [json.dumps(self._entries, indent=2, sort_keys=True)])
+
+
+class ScrapeDaemon(object):
+    """
+    Keeps the output up to date by polling the subreddits' stylesheets.
+
+    The first cycle streams all subreddits. Later cycles poll the due
+    stylesheets with conditional requests, stream only the subreddits whose
+    stylesheet changed and run the remaining stages (dedupe, tags, visual
+    dedupe, ...) over all emotes, with the emotes of the other subreddits
+    restored from the manifest. The metadata files are written after every
+    cycle that found a change.
+
+    options are passed to RedditEmoteScraper.scrape() (berrytube_tags,
+    bpm_tags, verify_cache).
+    """
+
+    def __init__(self, scraper, min_interval=600, max_interval=86400, **options):
+        self.scraper = scraper
+        self.options = options
+        self.schedule = PollSchedule(os.path.join(scraper.reddit_cache, 'poll_schedule.json'), min_interval, max_interval)
+        self._emotes_by_subreddit = {}
+        # Subreddits whose new stylesheet is in the session but not yet published.
+        self._pending = set()
+        # Cycles a pending subreddit may fail before it waits for its next change.
+        self.max_failures = 3
+        self._failures = {}
+
+    def run(self):
+        '''Scrape forever'''
+        self.full_cycle()
+        while True:
+            wait = self.schedule.next_poll(self.scraper.subreddits) - time()
+            if wait > 0:
+                logger.info("Next poll in {:.0f}s".format(wait))
+                sleep(wait)
+            try:
+                self.poll_cycle()
+            except Exception:
+                # The schedule was not updated and the changed subreddits are
+                # still pending (up to max_failures times), the next cycle
+                # polls and publishes them again.
+                logger.exception("Poll cycle failed")
+                sleep(self.schedule.min_interval)
+
+    def full_cycle(self):
+        '''Stream all subreddits and publish them'''
+        scraper = self.scraper
+        logger.info("Scraping all {} subreddits".format(len(scraper.subreddits)))
+        scraper._emote_inputs = {}
+        scraper._unchanged_emotes = set()
+        scraper._emote_rules = {}
+        self._emotes_by_subreddit = {}
+        failed = self._update(scraper.subreddits, download_css=True)
+        self._publish(set(scraper.subreddits) - set(failed), prune=True)
+        self._pending = self._retry(failed, scraper.subreddits)
+        self._compact_journal()
+        # Whether a stylesheet changed was not checked, what the schedule learned is kept.
+        now = time()
+        for subreddit in scraper.subreddits:
+            self.schedule.schedule_next(subreddit, now)
+        self.schedule.save()
+
+    def poll_cycle(self):
+        '''Poll the due subreddits, publish if a stylesheet changed. Returns the changed subreddits'''
+        scraper = self.scraper
+        due = self.schedule.due(scraper.subreddits, time())
+        if not due and not self._pending:
+            return []
+        logger.info("Polling {} subreddits".format(len(due)))
+        changed = scraper.poll_stylesheets(due)
+        # The session already has the new stylesheets, a later poll of them
+        # is not modified. Keep them until they are published.
+        self._pending.update(changed)
+        changed = [subreddit for subreddit in scraper.subreddits if subreddit in self._pending]
+
+        if changed:
+            logger.info("Stylesheets changed: {}".format(', '.join(changed)))
+            scraper._emote_inputs = {}
+            scraper._unchanged_emotes = set()
+            scraper._emote_rules = {}
+            try:
+                failed = self._update(changed, download_css=False)
+                self._publish(set(changed) - set(failed), prune=False)
+            except Exception:
+                self._pending = self._retry(changed, changed)
+                raise
+            self._pending = self._retry(failed, changed)
+            self._compact_journal()
+
+        now = time()
+        for subreddit in due:
+            self.schedule.record(subreddit, subreddit in changed, now)
+        self.schedule.save()
+        return changed
+
+    def _compact_journal(self):
+        # The daemon keeps its session, without this the journal would grow forever.
+        journal = DownloadJournal(os.path.join(self.scraper.session_cache, 'download_journal.log'))
+        logger.debug("{} unresolved downloads left in the journal".format(journal.compact()))
+
+    def _retry(self, failed, subreddits):
+        '''The failed subreddits of subreddits to try again in the next cycle, each at most max_failures times'''
+        retry = set()
+        for subreddit in subreddits:
+            if subreddit not in failed:
+                self._failures.pop(subreddit, None)
+                continue
+            self._failures[subreddit] = self._failures.get(subreddit, 0) + 1
+            if self._failures[subreddit] < self.max_failures:
+                retry.add(subreddit)
+            else:
+                logger.error("Giving up on {} after {} failed cycles, its emotes are updated on its next change".format(
+                    subreddit, self._failures.pop(subreddit)))
+        return retry
+
+    def _update(self, subreddits, download_css):
+        '''Streams subreddits, returns the ones that failed. Those keep the emotes they had.'''
+        emotes_by_subreddit = self.scraper._stream(subreddits, download_css, self.options.get('verify_cache', False),
+                                                   'telemetry_daemon.json')
+        failed = []
+        for subreddit in subreddits:
+            if subreddit not in emotes_by_subreddit:
+                failed.append(subreddit)
+                continue
+            # The later stages change the emotes, keep them as they were extracted.
+            self._emotes_by_subreddit[subreddit] = copy.deepcopy(emotes_by_subreddit[subreddit])
+        return failed
+
+    def _publish(self, changed, prune):
+        scraper = self.scraper
+
+        def collect_emotes():
+            scraper.emotes = []
+            for subreddit in scraper.subreddits:
+                emotes = copy.deepcopy(self._emotes_by_subreddit.get(subreddit, []))
+                if subreddit not in changed:
+                    # Their puzzle vectors are still in the manifest.
+                    scraper._unchanged_emotes.update(emote['canonical'] for emote in emotes)
+                scraper.emotes.extend(emotes)
+            if prune:
+                scraper._save_manifest()
+            else:
+                # Only the changed subreddits' spritemaps were hashed, pruning would forget the others.
+                scraper._emote_manifest().save()
+
+        scraper.scrape(collect=collect_emotes, **self.options)
+        scraper.write_emotes_metadata()
+        logger.info("Published {} emotes".format(len(scraper.emotes)))
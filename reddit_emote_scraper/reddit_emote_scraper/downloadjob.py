@@ -10,47 +10,145 @@
 #
 # --------------------------------------------------------------------
 
-from workerpool import Job
-from time import sleep
+from time import sleep, time
+import random
+from .downloadjournal import STARTED
+from .replay import replay_url
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-class DownloadJob(Job):
-    def __init__(self, requests, url, retry=1, rate_limit_lock=None, callback=None, **callbackargs):
-        super(DownloadJob, self).__init__()
+class DownloadJob(object):
+    def __init__(self, requests, url, retry=1, rate_limit_lock=None, validators=None,
+                 timeout=None, circuit_breaker=None, deadline=None, concurrency=None, journal=None,
+                 telemetry=None, replay_server=None, callback=None, **callbackargs):
         self._url = url
         self._requests = requests
 
         self._callback = callback
         self._callbackargs = callbackargs
         self._retry = retry
+        self._attempt = 0
         self.rate_limit_lock = rate_limit_lock
+        self.validators = validators
+        # (connect, read) timeout in seconds, passed on to requests.
+        self.timeout = timeout
+        self.circuit_breaker = circuit_breaker
+        # Absolute time after which the job gives up.
+        self.deadline = deadline
+        # ConcurrencyController that is told about latencies and throttling.
+        self.concurrency = concurrency
+        # DownloadJournal every attempt is recorded in.
+        self.journal = journal
+        # FetchTelemetry that gets timings, sizes, retries and waits.
+        self.telemetry = telemetry
+        # Replay server the request is sent to instead, everything else is keyed on the original url.
+        self.replay_server = replay_server
+        self._rate_limited_since = None
+        self._started = None
 
-    def run(self):
-        try:
-            response = None
+    def _backoff(self):
+        '''Capped exponential backoff with full jitter'''
+        return random.uniform(0, min(60, 2 * 2 ** self._attempt))
 
-            while (not response or response.status_code != 200) and self._retry > 0:
-                backoff = 0
-                try:
-                    self._retry -= 1
-                    self.rate_limit_lock and self.rate_limit_lock.acquire()
-                    response = self._requests.get(self._url)
-                    if ("over18" in response.url):
-                        response = self._requests.post(response.url, {"over18": "yes"})
-                except Exception, e:
-                    logger.exception(e)
-                    response = None
-                finally:
-                    if not response or response.status_code != 200:
-                        logger.warn("Error loading {}, retrying {} more times".format(self._url, self._retry))
-                        backoff += 10
-                        sleep(backoff)
+    def _response_size(self, response):
+        '''Bytes read from the network for response'''
+        try:
+            return response.raw.tell()
+        except AttributeError:
+            return int(response.headers.get('Content-Length', 0))
 
+    def _finish(self, response):
+        try:
             if self._callback:
                 self._callback(response, **self._callbackargs)
+            if self.telemetry and response is not None:
+                self.telemetry.record_transfer(self._url, time() - self._started, self._response_size(response))
+        except Exception, e:
+            logger.exception(e)
+        finally:
+            # The body is streamed by the callback, release the connection.
+            if response is not None:
+                response.close()
+        return None
+
+    def step(self):
+        '''
+        Makes one download attempt.
+
+        Returns None if the job is finished (the callback has been called) or
+        the number of seconds to wait before step() should be called again.
+        '''
+        if self.deadline is not None and time() >= self.deadline:
+            logger.error("Giving up on {}, stage deadline passed".format(self._url))
+            return self._finish(None)
+
+        if self.rate_limit_lock:
+            wait = self.rate_limit_lock.try_acquire(self._url)
+            if wait > 0:
+                if self.concurrency:
+                    self.concurrency.record_rate_limited()
+                if self._rate_limited_since is None:
+                    self._rate_limited_since = time()
+                return wait
+            if self._rate_limited_since is not None:
+                if self.telemetry:
+                    self.telemetry.record_rate_limit_wait(self._url, time() - self._rate_limited_since)
+                self._rate_limited_since = None
+
+        if self.circuit_breaker and not self.circuit_breaker.allow(self._url):
+            logger.error("Giving up on {}, host is down".format(self._url))
+            return self._finish(None)
+
+        response = None
+        try:
+            self._retry -= 1
+            self._attempt += 1
+            if self.journal:
+                self.journal.record(STARTED, self._url, attempt=self._attempt)
+            # Conditional request, a 304 means the cached copy is still valid.
+            headers = self.validators.headers(self._url) if self.validators else {}
+            self._started = time()
+            request_url = replay_url(self.replay_server, self._url) if self.replay_server else self._url
+            response = self._requests.get(request_url, headers=headers, timeout=self.timeout, stream=True)
+            if ("over18" in response.url):
+                response.close()
+                response = self._requests.post(response.url, {"over18": "yes"}, timeout=self.timeout, stream=True)
+            if self.rate_limit_lock:
+                self.rate_limit_lock.update(self._url, response)
+            if self.concurrency:
+                self.concurrency.record_response(time() - self._started, response.status_code)
+            if self.telemetry:
+                self.telemetry.record_response(self._url, response)
         except Exception, e:
-            logger.exception(e)
\ No newline at end of file
+            logger.exception(e)
+            response = None
+            if self.telemetry:
+                self.telemetry.record_error(self._url)
+
+        if self.circuit_breaker:
+            if response is None or response.status_code >= 500:
+                self.circuit_breaker.record_failure(self._url)
+            else:
+                self.circuit_breaker.record_success(self._url)
+
+        if (not response or response.status_code not in (200, 304)) and self._retry > 0:
+            backoff = self._backoff()
+            if self.deadline is None or time() + backoff < self.deadline:
+                logger.warn("Error loading {}, retrying {} more times".format(self._url, self._retry))
+                if response is not None:
+                    response.close()
+                if self.telemetry:
+                    self.telemetry.record_retry(self._url, backoff)
+                return backoff
+
+        return self._finish(response)
+
+    def run(self):
+        '''Runs the job to completion on the calling thread'''
+        delay = self.step()
+        while delay is not None:
+            sleep(delay)
+            delay = self.step()
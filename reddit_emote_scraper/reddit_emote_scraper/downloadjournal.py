@@ -0,0 +1,141 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Lock
+from time import time
+import json
+import os
+
+from .fileutils import write_atomic
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+STARTED = 'started'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+def is_permanent_failure(status):
+    '''A client error (except timeouts and rate limiting) will fail again, anything else may not'''
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+class DownloadJournal(object):
+    """
+    Append-only journal of downloads, one json object per line.
+
+    Every download is recorded when it is queued, when an attempt starts and
+    when it completed or failed (with byte count or status). A line is written
+    and flushed as it happens, so after a crash the journal tells which
+    downloads were still pending and how often each one failed before.
+    A torn last line (crash during a write) is ignored when reading.
+    A long running session compacts the journal to the unresolved downloads.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self._file = None
+
+    def load(self):
+        '''
+        Returns a dict of url to its state: {'path', 'state', 'failures', 'bytes'}
+
+        Only permanent failures are counted, a download that gave up on a
+        deadline, an open circuit breaker or a server error is tried again.
+        '''
+        downloads = {}
+        try:
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warn("Ignoring damaged line in download journal {}".format(self.filename))
+                        continue
+                    download = downloads.setdefault(entry['url'], {'failures': 0, 'bytes': None})
+                    download['path'] = entry.get('path', download.get('path'))
+                    download['state'] = entry['event']
+                    if entry['event'] == FAILED and is_permanent_failure(entry.get('status')):
+                        download['failures'] += 1
+                    elif entry['event'] == COMPLETED:
+                        download['bytes'] = entry.get('bytes')
+        except IOError:
+            pass
+        return downloads
+
+    def pending(self, downloads=None):
+        '''The downloads that were queued or started but never finished'''
+        if downloads is None:
+            downloads = self.load()
+        return dict((url, download) for url, download in downloads.iteritems()
+                    if download['state'] in (QUEUED, STARTED))
+
+    def compact(self):
+        '''
+        Rewrite the journal without the downloads that completed.
+
+        Of the other downloads the permanent failures and the last event are
+        kept, so their state and failure count stay the same. Returns the
+        number of downloads left in the journal.
+        '''
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            entries = {}
+            try:
+                with open(self.filename, 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        entries.setdefault(entry['url'], []).append((line, entry))
+            except IOError:
+                return 0
+
+            lines = []
+            downloads = 0
+            for url_entries in entries.itervalues():
+                if url_entries[-1][1]['event'] == COMPLETED:
+                    continue
+                downloads += 1
+                lines.extend(line for line, entry in url_entries[:-1]
+                             if entry['event'] == FAILED and is_permanent_failure(entry.get('status')))
+                lines.append(url_entries[-1][0].rstrip('\n') + '\n')
+            write_atomic(self.filename, lines)
+            return downloads
+
+    def record(self, event, url, **fields):
+        fields['event'] = event
+        fields['url'] = url
+        fields['time'] = time()
+        line = json.dumps(fields, separators=(',', ':'), sort_keys=True) + '\n'
+        with self.lock:
+            if self._file is None:
+                directory = os.path.dirname(self.filename)
+                if directory and not os.path.exists(directory):
+                    os.makedirs(directory)
+                self._file = open(self.filename, 'a')
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
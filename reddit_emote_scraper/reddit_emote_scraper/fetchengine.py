@@ -0,0 +1,163 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Thread, Condition
+from time import time
+import heapq
+import itertools
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Batch(object):
+    '''The jobs of one download phase, so a phase can wait for its own jobs only'''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.pending = 0
+
+    def put(self, job, delay=0, priority=0):
+        self.engine.put(job, delay, priority, batch=self)
+
+    def join(self):
+        '''Block until every job of this batch has finished'''
+        with self.engine._cond:
+            while self.pending > 0:
+                self.engine._cond.wait()
+
+
+class FetchEngine(object):
+    """
+    Runs download jobs on a fixed set of threads shared by all download phases.
+
+    A job is anything with a step() method. step() makes one attempt and returns
+    None when the job is finished, or the number of seconds after which it wants
+    to be stepped again (rate limit or retry backoff). Waiting jobs are kept in a
+    timer queue instead of sleeping on a thread, so threads only ever block on
+    the network.
+
+    Of the jobs that are ready, the one with the highest priority is stepped
+    first. A job keeps its priority when it is rescheduled.
+
+    The number of jobs being stepped at the same time is bounded by the limit
+    of the concurrency controller (if any), otherwise by the number of threads.
+
+    Download phases that run at the same time put their jobs in their own
+    batch() and join() that.
+    """
+
+    def __init__(self, workers=20, controller=None):
+        self.workers = controller.maximum if controller else workers
+        self.controller = controller
+        self._active = 0
+        self._waiting = []  # heap of (ready_at, sequence, priority, job, batch)
+        self._ready = []  # heap of (-priority, sequence, priority, job, batch)
+        self._sequence = itertools.count()
+        self._cond = Condition()
+        self._pending = 0
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = Thread(target=self._work, name='FetchEngine-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def batch(self):
+        return Batch(self)
+
+    def put(self, job, delay=0, priority=0, batch=None):
+        with self._cond:
+            self._pending += 1
+            if batch is not None:
+                batch.pending += 1
+            self._schedule(job, delay, priority, batch)
+
+    def join(self):
+        '''Block until every job that was put has finished'''
+        with self._cond:
+            while self._pending > 0:
+                self._cond.wait()
+
+    def shutdown(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _schedule(self, job, delay, priority, batch):
+        if delay > 0:
+            heapq.heappush(self._waiting, (time() + delay, next(self._sequence), priority, job, batch))
+        else:
+            heapq.heappush(self._ready, (-priority, next(self._sequence), priority, job, batch))
+        self._cond.notify_all()
+
+    def _promote_waiting(self):
+        '''Move the jobs whose wait is over to the ready queue'''
+        now = time()
+        while self._waiting and self._waiting[0][0] <= now:
+            ready_at, sequence, priority, job, batch = heapq.heappop(self._waiting)
+            heapq.heappush(self._ready, (-priority, sequence, priority, job, batch))
+
+    def _limit(self):
+        return self.controller.limit if self.controller else self.workers
+
+    def _next_job(self):
+        '''Returns (priority, job, batch) of the next job to step or None when shutting down'''
+        with self._cond:
+            while not self._stopping:
+                if self._active >= self._limit():
+                    self._cond.wait()
+                    continue
+                self._promote_waiting()
+                if self._ready:
+                    self._active += 1
+                    return heapq.heappop(self._ready)[2:]
+                if self._waiting:
+                    self._cond.wait(self._waiting[0][0] - time())
+                else:
+                    self._cond.wait()
+            return None
+
+    def _work(self):
+        while True:
+            entry = self._next_job()
+            if entry is None:
+                return
+
+            priority, job, batch = entry
+
+            try:
+                delay = job.step()
+            except Exception, e:
+                logger.exception(e)
+                delay = None
+
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+                if delay is None:
+                    self._pending -= 1
+                    if batch is not None:
+                        batch.pending -= 1
+                else:
+                    self._schedule(job, delay, priority, batch)
@@ -0,0 +1,58 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import fcntl
+import os
+
+from .fileutils import makedirs
+
+
+class FileLock(object):
+    """
+    Exclusive advisory lock (flock) on a lock file, between processes.
+
+    Every FileLock opens the lock file itself, so two FileLocks on the same
+    file also exclude each other within one process.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        '''Returns True if the lock was acquired, with blocking=False False if it is held elsewhere'''
+        directory = os.path.dirname(self.filename)
+        if directory:
+            makedirs(directory)
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            if blocking:
+                raise
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,96 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+import os
+import errno
+import tempfile
+import time
+import threading
+
+CHUNK_SIZE = 64 * 1024
+
+
+def makedirs(directory):
+    '''os.makedirs() that does not fail if the directory already exists (or is created concurrently)'''
+    try:
+        os.makedirs(directory)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def write_atomic(file_path, chunks, modified_timestamp=None):
+    """
+    Write chunks of data to file_path.
+
+    The data is written to a temporary file in the same directory, fsynced and
+    then renamed over file_path. A reader (or a killed run) never sees a
+    partially written file. Unicode chunks are written as utf-8.
+
+    Returns the number of bytes written.
+    """
+    directory = os.path.dirname(file_path)
+    makedirs(directory)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_path), suffix='.tmp')
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0644)
+        if modified_timestamp is not None:
+            os.utime(tmp_path, (time.time(), modified_timestamp))
+        os.rename(tmp_path, file_path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return size
+
+
+def _counted(chunks, consume_bytes):
+    for chunk in chunks:
+        consume_bytes(len(chunk.encode('utf-8')) if isinstance(chunk, unicode) else len(chunk))
+        yield chunk
+
+
+def write_response_atomic(response, file_path, modified_timestamp=None, decode_unicode=False, consume_bytes=None):
+    '''
+    Stream the body of a (stream=True) requests response to file_path, see write_atomic()
+
+    consume_bytes is called with the size of every chunk as it is read (for rate limiting).
+    '''
+    chunks = response.iter_content(chunk_size=CHUNK_SIZE, decode_unicode=decode_unicode)
+    if consume_bytes is not None:
+        chunks = _counted(chunks, consume_bytes)
+    return write_atomic(file_path, chunks, modified_timestamp)
+
+
+def symlink_atomic(source, link_name):
+    '''Create or replace the symlink link_name pointing to source'''
+    tmp_link_name = '{}.{}.{}.tmp'.format(link_name, os.getpid(), threading.current_thread().ident)
+    try:
+        os.remove(tmp_link_name)
+    except OSError:
+        pass
+    os.symlink(source, tmp_link_name)
+    os.rename(tmp_link_name, link_name)
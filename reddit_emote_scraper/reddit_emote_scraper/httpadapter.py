@@ -0,0 +1,48 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from time import time
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+def _timed_pool_classes(telemetry):
+    '''Connection pool classes whose connections report their connect time'''
+    def timed(pool_class):
+        class TimedConnection(pool_class.ConnectionCls):
+            def connect(self):
+                started = time()
+                pool_class.ConnectionCls.connect(self)
+                telemetry.record_connect(self.host, time() - started)
+
+        class TimedConnectionPool(pool_class):
+            ConnectionCls = TimedConnection
+
+        return TimedConnectionPool
+
+    return {
+        'http': timed(HTTPConnectionPool),
+        'https': timed(HTTPSConnectionPool),
+    }
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    '''HTTPAdapter that records the connect time of every new connection in telemetry'''
+
+    def __init__(self, telemetry, **kwargs):
+        self.telemetry = telemetry
+        super(TimedHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _timed_pool_classes(self.telemetry)
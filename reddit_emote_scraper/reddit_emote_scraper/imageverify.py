@@ -0,0 +1,146 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+"""
+Structural integrity checks of cached images.
+
+The chunk/segment structure (and for png the chunk CRCs) is walked without
+decoding any pixels. This finds truncated and corrupted downloads in a
+fraction of the time Image.open() plus a full decode would take.
+"""
+
+import struct
+import zlib
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Chunk data is read in blocks of this size, a corrupt chunk length does not allocate its size.
+READ_SIZE = 64 * 1024
+
+
+def verify_png(f):
+    if f.read(8) != PNG_SIGNATURE:
+        return False
+
+    first = True
+    while True:
+        header = f.read(8)
+        if len(header) != 8:
+            return False  # Truncated, no IEND
+        length, chunk_type = struct.unpack('>I4s', header)
+        if first and chunk_type != 'IHDR':
+            return False
+        first = False
+
+        checksum = zlib.crc32(chunk_type)
+        remaining = length
+        while remaining:
+            data = f.read(min(remaining, READ_SIZE))
+            if not data:
+                return False  # Truncated, or a corrupt length past the end of the file
+            checksum = zlib.crc32(data, checksum)
+            remaining -= len(data)
+        crc = f.read(4)
+        if len(crc) != 4:
+            return False
+        if checksum & 0xffffffff != struct.unpack('>I', crc)[0]:
+            return False
+
+        if chunk_type == 'IEND':
+            return True
+
+
+def verify_jpeg(f):
+    if f.read(2) != '\xff\xd8':
+        return False
+
+    # Walk the marker segments up to the start of scan.
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2 or marker[0] != '\xff':
+            return False
+        while marker[1] == '\xff':  # Fill bytes
+            marker = marker[1] + f.read(1)
+        if marker[1] == '\xd9':
+            return True
+        if marker[1] in '\x01\xd0\xd1\xd2\xd3\xd4\xd5\xd6\xd7':
+            continue  # Markers without a length
+        length = f.read(2)
+        if len(length) != 2:
+            return False
+        length = struct.unpack('>H', length)[0]
+        if length < 2:
+            return False
+        if marker[1] == '\xda':
+            break
+        f.seek(length - 2, 1)
+
+    # The entropy coded data is not walked, a complete file ends with EOI.
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(max(0, size - 64))
+    return f.read().rstrip('\x00\r\n ').endswith('\xff\xd9')
+
+
+def verify_gif(f):
+    if f.read(6) not in ('GIF87a', 'GIF89a'):
+        return False
+    f.seek(-1, 2)
+    return f.read(1) == ';'
+
+
+def verify_image(file_path):
+    '''Returns False if file_path is a truncated or corrupt png, jpeg or gif'''
+    try:
+        with open(file_path, 'rb') as f:
+            magic = f.read(8)
+            f.seek(0)
+            if magic.startswith(PNG_SIGNATURE):
+                return verify_png(f)
+            if magic.startswith('\xff\xd8'):
+                return verify_jpeg(f)
+            if magic.startswith('GIF8'):
+                return verify_gif(f)
+            # Unknown formats can not be verified, an empty file is broken.
+            return len(magic) > 0
+    except Exception as ex:
+        # Whatever a corrupt file makes the checks do, it is broken.
+        logger.debug("Verifying {} failed: {}".format(file_path, ex))
+        return False
+
+
+def find_broken_images(file_paths, processes=None, pool=None):
+    '''
+    Verifies file_paths in parallel (in this process if processes is 1), returns the paths of the broken images
+
+    Runs on pool if given, else on a pool created for this call.
+    '''
+    file_paths = list(file_paths)
+    if processes == 1:
+        return [file_path for file_path in file_paths if not verify_image(file_path)]
+    if not file_paths:
+        return []
+    if pool is not None:
+        results = pool.map(verify_image, file_paths, chunksize=64)
+    else:
+        from multiprocessing import Pool
+        pool = Pool(processes=processes)
+        try:
+            results = pool.map(verify_image, file_paths, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+    return [file_path for file_path, valid in zip(file_paths, results) if not valid]
@@ -0,0 +1,92 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Lock, Event
+import os
+
+from .filelock import FileLock
+
+
+class InFlight(object):
+    """
+    Registry of downloads in flight, keyed by the cache file they write to.
+
+    The first requester of a key claims it and downloads, later requesters
+    of the same key do not start a second download but can wait() for the
+    first one. This saves rate limit tokens and keeps two writers away from
+    the same cache file.
+
+    Claims are also taken between processes sharing the cache, with a lock
+    file next to the cache file. A file another process is downloading is
+    not claimed, wait() waits for that process. Claimers check for the file
+    after locking, so the lock file is removed once the file is in the cache.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self._events = {}
+        self._file_locks = {}
+
+    def _key(self, file_path):
+        return os.path.normpath(file_path)
+
+    def _lock_path(self, key):
+        directory, name = os.path.split(key)
+        return os.path.join(directory, '.' + name + '.lock')
+
+    def claim(self, file_path):
+        '''Returns True if the caller should download file_path, False if it is already in flight'''
+        key = self._key(file_path)
+        with self.lock:
+            if key in self._events:
+                return False
+            self._events[key] = Event()
+
+        file_lock = FileLock(self._lock_path(key))
+        if file_lock.acquire(blocking=False):
+            if not os.path.isfile(key):
+                with self.lock:
+                    self._file_locks[key] = file_lock
+                return True
+            # Another process downloaded it since the caller looked.
+            file_lock.release()
+        # Otherwise another process is downloading it.
+        self.release(file_path)
+        return False
+
+    def release(self, file_path):
+        '''Called by the claimer when its download finished, successful or not'''
+        key = self._key(file_path)
+        with self.lock:
+            event = self._events.pop(key, None)
+            file_lock = self._file_locks.pop(key, None)
+        if file_lock:
+            if os.path.isfile(key):
+                try:
+                    os.remove(self._lock_path(key))
+                except OSError:
+                    pass
+            file_lock.release()
+        if event:
+            event.set()
+
+    def wait(self, file_path, timeout=None):
+        '''Wait for the download of file_path (if any is in flight) to finish, timeout is for this process only'''
+        key = self._key(file_path)
+        with self.lock:
+            event = self._events.get(key)
+        if event:
+            event.wait(timeout)
+        if not os.path.isfile(key) and os.path.exists(self._lock_path(key)):
+            # Downloading in another process, its lock is released when it is done.
+            with FileLock(self._lock_path(key)):
+                pass
@@ -0,0 +1,271 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Lock
+import base64
+import hashlib
+import json
+import os
+
+from .fileutils import write_atomic
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bump when the extraction or cropping code changes its output.
+MANIFEST_VERSION = 1
+
+# Emote keys that do not change the extracted image.
+IGNORED_KEYS = ['names', 'tags', 'Last-Modified']
+
+# Emote keys set by extracting and cropping.
+OUTPUT_KEYS = [
+    'width',
+    'height',
+    'background-position',
+    'hover-width',
+    'hover-height',
+    'hover-background-position',
+    'has_hover',
+    'base_img_animation',
+    'hover_img_animation',
+    'single_image_extension',
+    'single_hover_image_extension',
+]
+
+# How an emote's rule changed since the last run, see diff_rules().
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def declarations_hash(emote):
+    '''Hash of the emote's css declarations, without the keys that do not change its image'''
+    declarations = dict((k, v) for k, v in emote.iteritems() if k not in IGNORED_KEYS)
+    return _sha1(json.dumps(declarations, sort_keys=True))
+
+
+def diff_rules(old_rules, new_rules):
+    '''
+    Compares two rule sets of a subreddit (canonical name to declarations_hash()).
+
+    Returns a dict of canonical name to ADDED, REMOVED, CHANGED or UNCHANGED.
+    '''
+    changes = {}
+    for name, rules_hash in new_rules.iteritems():
+        if name not in old_rules:
+            changes[name] = ADDED
+        elif old_rules[name] != rules_hash:
+            changes[name] = CHANGED
+        else:
+            changes[name] = UNCHANGED
+    for name in old_rules:
+        if name not in new_rules:
+            changes[name] = REMOVED
+    return changes
+
+
+class EmoteManifest(object):
+    """
+    Remembers what every emote was built from and what it produced.
+
+    For each emote the hash of its css declarations and of its spritemap
+    file(s) is stored together with the values extracting and cropping wrote
+    to the emote, and its compressed puzzle vector. If the inputs of an emote
+    did not change since the last run, its outputs can be restored instead
+    of extracting, cropping and fingerprinting the emote again.
+
+    The rule set of every subreddit (the declarations hash of its emotes) is
+    stored too, to tell which emotes were added, removed or changed.
+    So are the hashes of the spritemaps that passed verify_cache, a file
+    with the same content is not verified again.
+
+    File hashes are cached by size and modification time so unchanged
+    spritemaps are not read again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self._files = {}
+        self._emotes = {}
+        self._rules = {}
+        self._verified = set()
+        self._used_files = set()
+        self._dirty = False
+
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self._files = data['files']
+                self._emotes = data['emotes']
+                self._rules = data.get('rules', {})
+                self._verified = set(data.get('verified', []))
+            else:
+                logger.info("Ignoring manifest {} of an older version".format(filename))
+        except (IOError, ValueError, KeyError) as ex:
+            logger.debug("Could not read manifest {}: {}".format(filename, ex))
+
+    def file_hash(self, file_path):
+        '''sha1 of the file's content, None if it can not be read'''
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        with self.lock:
+            self._used_files.add(file_path)
+            cached = self._files.get(file_path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            return cached[2]
+
+        try:
+            with open(file_path, 'rb') as f:
+                digest = _sha1(f.read())
+        except IOError:
+            return None
+        with self.lock:
+            self._files[file_path] = [stat.st_size, stat.st_mtime, digest]
+            self._dirty = True
+        return digest
+
+    def used_files(self):
+        '''The cached file hashes used in this run, for merging them into another manifest'''
+        with self.lock:
+            return dict((file_path, self._files[file_path]) for file_path in self._used_files if file_path in self._files)
+
+    def add_files(self, files):
+        '''Adds the used_files() of another manifest'''
+        with self.lock:
+            self._files.update(files)
+            self._used_files.update(files)
+            self._dirty = True
+
+    def verified(self, file_path):
+        '''True if a file with the content of file_path was verified before'''
+        digest = self.file_hash(file_path)
+        with self.lock:
+            return digest is not None and digest in self._verified
+
+    def set_verified(self, file_paths):
+        for file_path in file_paths:
+            digest = self.file_hash(file_path)
+            if digest is not None:
+                with self.lock:
+                    self._verified.add(digest)
+                    self._dirty = True
+
+    def inputs_hash(self, emote, file_paths):
+        '''Hash of the emote's declarations and of the files in file_paths, None if a file is missing'''
+        hashes = [declarations_hash(emote)]
+        for file_path in file_paths:
+            digest = self.file_hash(file_path)
+            if digest is None:
+                return None
+            hashes.append(digest)
+        return _sha1(' '.join(hashes))
+
+    def outputs(self, emote, inputs):
+        '''The recorded outputs of emote if it was built from inputs, else None'''
+        if inputs is None:
+            return None
+        with self.lock:
+            entry = self._emotes.get(emote['canonical'])
+        if entry and entry['inputs'] == inputs:
+            return entry['outputs']
+        return None
+
+    def record(self, emote, inputs):
+        '''Record the outputs emote was built to from inputs'''
+        if inputs is None:
+            return
+        outputs = dict((k, emote[k]) for k in OUTPUT_KEYS if k in emote)
+        with self.lock:
+            self._emotes[emote['canonical']] = {'inputs': inputs, 'outputs': outputs}
+            self._dirty = True
+
+    def vector(self, emote):
+        '''The compressed puzzle vector of emote's image, None if not known'''
+        with self.lock:
+            entry = self._emotes.get(emote['canonical'])
+        if entry and 'vector' in entry:
+            return base64.b64decode(entry['vector'])
+        return None
+
+    def set_vector(self, emote, compressed_vector):
+        with self.lock:
+            entry = self._emotes.get(emote['canonical'])
+            if entry is not None:
+                entry['vector'] = base64.b64encode(compressed_vector)
+                self._dirty = True
+
+    def rules(self, subreddit):
+        '''The rule set of subreddit recorded by the last run'''
+        with self.lock:
+            return dict(self._rules.get(subreddit, {}))
+
+    def record_rules(self, subreddit, rules):
+        with self.lock:
+            if self._rules.get(subreddit) != rules:
+                self._rules[subreddit] = dict(rules)
+                self._dirty = True
+
+    def forget(self, canonical_names):
+        '''Forget the outputs of the emotes in canonical_names that are in no recorded rule set'''
+        with self.lock:
+            ruled = set(name for rules in self._rules.itervalues() for name in rules)
+            forgotten = [name for name in canonical_names if name not in ruled and name in self._emotes]
+            for name in forgotten:
+                del self._emotes[name]
+                self._dirty = True
+        return forgotten
+
+    def prune(self, canonical_names, subreddits=None):
+        '''
+        Forget the emotes that are not in canonical_names and the files not hashed in this run.
+
+        If subreddits is given the rule sets of other subreddits are forgotten too.
+        '''
+        canonical_names = set(canonical_names)
+        with self.lock:
+            if subreddits is not None:
+                for subreddit in self._rules.keys():
+                    if subreddit not in subreddits:
+                        del self._rules[subreddit]
+                        self._dirty = True
+            for file_path in self._files.keys():
+                if file_path not in self._used_files:
+                    del self._files[file_path]
+                    self._dirty = True
+            digests = set(entry[2] for entry in self._files.itervalues())
+            if not self._verified <= digests:
+                self._verified &= digests
+                self._dirty = True
+            for name in self._emotes.keys():
+                if name not in canonical_names:
+                    del self._emotes[name]
+                    self._dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self._dirty:
+                return
+            data = {'version': MANIFEST_VERSION, 'files': self._files, 'emotes': self._emotes, 'rules': self._rules,
+                    'verified': sorted(self._verified)}
+            write_atomic(self.filename, [json.dumps(data, separators=(',', ':'), sort_keys=True)])
+            self._dirty = False
@@ -24,6 +24,9 @@
 
 from time import time, sleep
 from threading import Lock
+from email.utils import parsedate
+import calendar
+import urlparse
 
 
 class TokenBucket:
@@ -34,7 +37,7 @@ class TokenBucket:
     def __init__(self, rate=1, per_seconds=1, block=True):
         self.tokens = rate
         self.rate = rate
-        self.block = True
+        self.block = block
         self.last = time()
         self.lock = Lock()
         self.per_seconds = per_seconds
@@ -53,21 +56,181 @@ class TokenBucket:
             self.tokens = self.rate
 
     def acquire(self):
+        """
+        Take a token. Waits for it when blocking (without holding the lock),
+        otherwise returns the number of seconds until a token is available.
+        """
+        wait = self.try_acquire()
+        while wait > 0 and self.block:
+            sleep(wait)
+            wait = self.try_acquire()
+        return wait
+
+    def try_acquire(self, url=None):
+        """
+        Take a token without waiting.
+
+        Returns 0 if a token was taken, otherwise the number of seconds
+        until a token will be available.
+        """
         with self.lock:
             if not self.rate:
                 return 0
 
             self.increment()
 
-            if self.block and self.tokens < 1:
-                sleep_time = (self.per_seconds / self.rate) - self.tokens
-                sleep(abs(sleep_time))
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
 
-            self.tokens -= 1
+            return (1 - self.tokens) * self.per_seconds / float(self.rate)
 
-            if self.block:
-                return 0
-            else:
-                return abs((self.per_seconds / self.rate) - self.tokens)
+    def update(self, url, response):
+        """
+        A single bucket does not look at responses.
+        Present so a TokenBucket can be used where a HostRateScheduler is expected.
+        """
+        pass
+
+    def consume_bytes(self, url, count):
+        """
+        A single bucket does not limit bytes.
+        Present so a TokenBucket can be used where a HostRateScheduler is expected.
+        """
+        pass
+
+
+def _retry_after_seconds(value):
+    '''Retry-After is either a number of seconds or a http date'''
+    try:
+        return float(value)
+    except ValueError:
+        date_tuple = parsedate(value)
+        if date_tuple is None:
+            return None
+        return calendar.timegm(date_tuple) - time()
+
+
+class _HostBudget:
+    """
+    The request and byte budget of a group of hosts.
+
+    Besides the token bucket it tracks what the server tells us in the
+    X-Ratelimit-* and Retry-After headers.
+    """
+
+    def __init__(self, bucket, max_bytes_per_second=None):
+        self.bucket = bucket
+        self.lock = Lock()
+        self.blocked_until = 0
+        self.remaining = None
+        self.reset_at = 0
+        self.max_bytes_per_second = max_bytes_per_second
+        self.byte_allowance = max_bytes_per_second or 0
+        self.byte_last = time()
+
+    def _refill_bytes(self, now):
+        self.byte_allowance += (now - self.byte_last) * self.max_bytes_per_second
+        self.byte_allowance = min(self.byte_allowance, self.max_bytes_per_second)
+        self.byte_last = now
+
+    def try_acquire(self):
+        with self.lock:
+            now = time()
+
+            if now < self.blocked_until:
+                return self.blocked_until - now
+
+            if self.max_bytes_per_second:
+                self._refill_bytes(now)
+                # Bytes are counted after the fact, a negative allowance is paid off first.
+                if self.byte_allowance < 0:
+                    return -self.byte_allowance / float(self.max_bytes_per_second)
+
+            if self.remaining is not None:
+                if now >= self.reset_at:
+                    self.remaining = None
+                elif self.remaining < 1:
+                    return self.reset_at - now
+
+            wait = self.bucket.try_acquire()
+            if wait == 0 and self.remaining is not None:
+                self.remaining -= 1
+            return wait
+
+    def update(self, response):
+        headers = response.headers
+        with self.lock:
+            now = time()
+
+            retry_after = headers.get('Retry-After')
+            if retry_after is not None:
+                seconds = _retry_after_seconds(retry_after)
+                if seconds is not None:
+                    self.blocked_until = max(self.blocked_until, now + seconds)
+
+            remaining = headers.get('X-Ratelimit-Remaining')
+            reset = headers.get('X-Ratelimit-Reset')
+            if remaining is not None and reset is not None:
+                try:
+                    self.remaining = float(remaining)
+                    self.reset_at = now + float(reset)
+                except ValueError:
+                    pass
+
+    def consume_bytes(self, count):
+        if not self.max_bytes_per_second:
+            return
+        with self.lock:
+            self._refill_bytes(time())
+            self.byte_allowance -= count
+
+
+class HostRateScheduler:
+    """
+    Rate limits requests with a separate budget per group of hosts.
+
+    Hosts are matched on their domain suffix, so 'reddit.com' covers
+    pay.reddit.com and www.reddit.com. Requests to hosts without a budget
+    use the default bucket (or are not limited if there is none).
+    Every budget follows the rate limit headers of its responses.
+    """
+
+    def __init__(self, default=None, max_bytes_per_second=None):
+        self._routes = []
+        self._default = _HostBudget(default or TokenBucket(rate=0), max_bytes_per_second)
+
+    def add_host(self, host_suffixes, bucket, max_bytes_per_second=None):
+        '''Gives the hosts matching any of host_suffixes one shared budget'''
+        budget = _HostBudget(bucket, max_bytes_per_second)
+        if isinstance(host_suffixes, basestring):
+            host_suffixes = [host_suffixes]
+        for host_suffix in host_suffixes:
+            self._routes.append((host_suffix.lower(), budget))
+
+    def _budget(self, url):
+        host = (urlparse.urlparse(url).hostname or '').lower()
+        for host_suffix, budget in self._routes:
+            if host == host_suffix or host.endswith('.' + host_suffix):
+                return budget
+        return self._default
+
+    def try_acquire(self, url=None):
+        return self._budget(url or '').try_acquire()
+
+    def acquire(self, url=None):
+        wait = self.try_acquire(url)
+        while wait > 0:
+            sleep(wait)
+            wait = self.try_acquire(url)
+        return 0
+
+    def update(self, url, response):
+        '''Feed the rate limit headers of a response for url back into its budget'''
+        self._budget(url).update(response)
+
+    def consume_bytes(self, url, count):
+        '''Charge count bytes of a response body from url, as they are read'''
+        self._budget(url).consume_bytes(count)
 
 
@@ -0,0 +1,247 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+"""
+Record real responses and replay them from a local http server.
+
+A RedditEmoteScraper with a recorder stores every stylesheet, spritemap and
+tag file it downloads or finds unchanged in its cache (with the headers that
+matter to the scraper). The
+ReplayServer serves a recording with configurable latency, throttling
+(429 + X-Ratelimit-* headers) and failures. Point a scraper at it with
+replay_server so download engine changes can be measured offline:
+
+    python -m reddit_emote_scraper.replay recording --port 8080 --latency 0.1
+"""
+
+from threading import Lock
+from time import sleep
+from email.utils import formatdate
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import urlparse
+
+from .ratelimiter import TokenBucket
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+RECORDED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified']
+
+
+def replay_url(server, url):
+    '''Rewrite url (https://host/path) to its location on the replay server (server/https/host/path)'''
+    if url.startswith(server.rstrip('/') + '/'):
+        return url  # Already rewritten
+    parts = urlparse.urlsplit(url)
+    replayed = '{}/{}/{}{}'.format(server.rstrip('/'), parts.scheme, parts.netloc, parts.path)
+    if parts.query:
+        replayed += '?' + parts.query
+    return replayed
+
+
+def original_url(path):
+    '''The inverse of replay_url() for the path part of a replay server url'''
+    scheme, _, rest = path.lstrip('/').partition('/')
+    return '{}://{}'.format(scheme, rest)
+
+
+class Recorder(object):
+    """
+    Stores responses in a recording directory.
+
+    The directory contains index.json (url to status, headers and body file)
+    and a bodies/ directory with the response bodies.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = Lock()
+        self._index = {}
+        try:
+            with open(os.path.join(directory, 'index.json')) as f:
+                self._index = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def record(self, url, response, body_path):
+        '''
+        Record response for url, its body has been written to body_path.
+
+        A 304 is recorded as a 200 with the cached file at body_path as body.
+        '''
+        headers = dict((k, response.headers[k]) for k in RECORDED_HEADERS if k in response.headers)
+        status = 200 if response.status_code == 304 else response.status_code
+        self._record(url, response.url, status, headers, body_path)
+
+    def record_file(self, url, body_path):
+        '''Record a 200 for url with the file at body_path, that is cached and was not requested'''
+        self._record(url, url, 200, {}, body_path)
+
+    def _record(self, url, final_url, status, headers, body_path):
+        if 'Last-Modified' not in headers:
+            # Cached files have the modification time of their response.
+            headers['Last-Modified'] = formatdate(os.path.getmtime(body_path), usegmt=True)
+        body_name = os.path.join('bodies', hashlib.sha1(final_url).hexdigest())
+        body_dir = os.path.join(self.directory, 'bodies')
+        with self.lock:
+            if not os.path.exists(body_dir):
+                os.makedirs(body_dir)
+            shutil.copyfile(body_path, os.path.join(self.directory, body_name))
+            if final_url != url:
+                # Stylesheets redirect to their file on the thumbs server.
+                self._index[url] = {'status': 302, 'headers': {'Location': final_url}}
+            self._index[final_url] = {
+                'status': status,
+                'headers': headers,
+                'body': body_name,
+            }
+
+    def save(self):
+        with self.lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            with open(os.path.join(self.directory, 'index.json'), 'w') as f:
+                json.dump(self._index, f, indent=2, sort_keys=True)
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, headers, body=''):
+        self.send_response(status)
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        # over18 confirmation, answered with what was recorded for the page.
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        url = original_url(self.path)
+        host = urlparse.urlsplit(url).hostname
+
+        if server.latency:
+            sleep(random.uniform(server.latency / 2.0, server.latency * 1.5))
+
+        throttle_headers = {}
+        bucket = server.bucket(host)
+        if bucket:
+            wait = bucket.try_acquire()
+            reset = bucket.per_seconds
+            throttle_headers = {
+                'X-Ratelimit-Remaining': str(int(bucket.tokens)),
+                'X-Ratelimit-Reset': str(int(math.ceil(wait or reset))),
+            }
+            if wait > 0:
+                throttle_headers['Retry-After'] = str(int(math.ceil(wait)))
+                return self._send(429, throttle_headers)
+
+        if server.failure_rate and random.random() < server.failure_rate:
+            if random.random() < 0.5:
+                # A dropped connection
+                self.close_connection = 1
+                return
+            return self._send(random.choice([500, 502, 503]), throttle_headers)
+
+        entry = server.index.get(url)
+        if entry is None:
+            return self._send(404, throttle_headers)
+
+        headers = dict(entry['headers'])
+        headers.update(throttle_headers)
+
+        if 'Location' in headers:
+            headers['Location'] = replay_url(server.url, headers['Location'])
+            return self._send(entry['status'], headers)
+
+        if (self.headers.get('If-None-Match') and self.headers.get('If-None-Match') == headers.get('ETag')) or \
+           (self.headers.get('If-Modified-Since') and self.headers.get('If-Modified-Since') == headers.get('Last-Modified')):
+            return self._send(304, headers)
+
+        with open(os.path.join(server.directory, entry['body']), 'rb') as f:
+            body = f.read()
+        self._send(entry['status'], headers, body)
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a recording made by Recorder.
+
+    latency: mean seconds added to every response.
+    rate / per_seconds: per host request budget, exceeding it gives a 429.
+    failure_rate: fraction of requests that fail with a 5xx or a dropped connection.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, address=('127.0.0.1', 8080), latency=0, rate=None, per_seconds=1, failure_rate=0):
+        HTTPServer.__init__(self, address, _ReplayHandler)
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json')) as f:
+            self.index = json.load(f)
+        self.latency = latency
+        self.rate = rate
+        self.per_seconds = per_seconds
+        self.failure_rate = failure_rate
+        self._buckets = {}
+        self._lock = Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def bucket(self, host):
+        if not self.rate:
+            return None
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.per_seconds, block=False)
+            return self._buckets[host]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recording of reddit stylesheets and spritemaps.')
+    parser.add_argument('directory', help="Recording directory (made with --record)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help="Mean latency in seconds")
+    parser.add_argument('--rate', type=float, default=None, help="Requests per host allowed every --per-seconds")
+    parser.add_argument('--per-seconds', type=float, default=1)
+    parser.add_argument('--failure-rate', type=float, default=0, help="Fraction of requests that fail")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server = ReplayServer(args.directory, (args.host, args.port), args.latency, args.rate, args.per_seconds, args.failure_rate)
+    logger.info("Replaying {} urls on {}".format(len(server.index), server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
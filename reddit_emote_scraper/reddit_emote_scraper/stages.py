@@ -0,0 +1,173 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Thread, Condition
+from time import time
+import sys
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+    A step of the scrape pipeline.
+
+    requires names the stages whose results this stage reads. A stage without
+    a function is disabled: it is skipped, the stages requiring it still run.
+    """
+
+    def __init__(self, name, function, requires=()):
+        self.name = name
+        self.function = function
+        self.requires = list(requires)
+
+
+class StageExecutor(object):
+    """
+    Runs stages on a set of threads as soon as the stages they require finished.
+
+    Independent stages overlap, like the tag downloads with the stylesheet
+    download. Ready stages are started in the order they were declared.
+    The threads are kept between calls to run() until shutdown().
+
+    If a stage fails no further stages are started, run() waits for the
+    running ones and raises the exception of the failed stage.
+
+    With a checkpoint function the stages run one at a time in the order they
+    were declared instead. Before every stage that is started, and after the
+    last one, checkpoint is called with the set of finished stage names, so
+    the state before every stage can be saved and resumed at.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._cond = Condition()
+        self._queue = []
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = Thread(target=self._work, name='StageExecutor-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def shutdown(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _check(self, stages):
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError("Duplicate stage names in {}".format(names))
+        declared = set()
+        for stage in stages:
+            for required in stage.requires:
+                if required not in names:
+                    raise ValueError("Stage {} requires unknown stage {}".format(stage.name, required))
+                if required not in declared:
+                    # Declaring requirements first rules out cycles
+                    raise ValueError("Stage {} requires {} which is declared after it".format(stage.name, required))
+            declared.add(stage.name)
+
+    def run(self, stages, checkpoint=None):
+        '''Run stages, returns a dict of stage name to the seconds it took'''
+        self._check(stages)
+        self.start()
+
+        done = set()
+        started = set()
+        running = [0]
+        failure = []
+        durations = {}
+        ran = [False]
+        checkpointed = [None]
+
+        def save():
+            if len(done) != checkpointed[0]:
+                checkpoint(set(done))
+                checkpointed[0] = len(done)
+
+        def finished(stage, seconds, exc_info):
+            with self._cond:
+                running[0] -= 1
+                durations[stage.name] = seconds
+                if exc_info:
+                    failure.append(exc_info)
+                else:
+                    done.add(stage.name)
+                    ran[0] = True
+                self._cond.notify_all()
+
+        with self._cond:
+            while True:
+                if checkpoint and not failure and running[0] == 0 and ran[0]:
+                    # The state after the last stage that ran
+                    save()
+                if not failure:
+                    for stage in stages:
+                        if stage.name in started:
+                            continue
+                        if checkpoint and running[0]:
+                            break  # One at a time
+                        if not all(r in done for r in stage.requires):
+                            continue
+                        started.add(stage.name)
+                        if stage.function is None:
+                            logger.debug("Skipping disabled stage {}".format(stage.name))
+                            done.add(stage.name)
+                            continue
+                        if checkpoint:
+                            save()
+                        running[0] += 1
+                        self._queue.append((stage, finished))
+                        self._cond.notify_all()
+                if running[0] == 0 and (failure or len(done) == len(stages)):
+                    break
+                self._cond.wait()
+
+        if failure:
+            exc_type, exc_value, exc_traceback = failure[0]
+            raise exc_type, exc_value, exc_traceback
+        return durations
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                stage, finished = self._queue.pop(0)
+
+            logger.debug("Starting stage {}".format(stage.name))
+            start = time()
+            exc_info = None
+            try:
+                stage.function()
+            except Exception:
+                logger.error("Stage {} failed".format(stage.name))
+                exc_info = sys.exc_info()
+            seconds = time() - start
+            logger.debug("Finished stage {} in {:.1f}s".format(stage.name, seconds))
+            finished(stage, seconds, exc_info)
@@ -0,0 +1,320 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+
+"""
+Parsing subreddit stylesheets into emotes.
+
+These are plain functions so process_stylesheets() can run them on a
+process pool, stylesheets are parsed on all cores.
+"""
+
+from collections import defaultdict
+import itertools
+import re
+
+from .emote import canonical_name
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bump when parse_css() changes its output, results cached by an older version are not used.
+PARSER_VERSION = 1
+
+re_emote = re.compile('a\[href[|^$]?=["\']/([\w:]+)["\']\](:hover)?(\sem|\sstrong)?')
+
+_cssparser = None
+_scanner = None
+
+
+def _css_parser():
+    '''The tinycss parser, made once per process'''
+    global _cssparser
+    if _cssparser is None:
+        import tinycss
+        _cssparser = tinycss.make_parser('page3')
+    return _cssparser
+
+
+class _Scanner(object):
+    """
+    Regular expressions finding the structure of a stylesheet like tinycss does.
+
+    They are made from tinycss' own token definitions, so comments, strings,
+    url()s and escapes (which may contain brackets and semicolons) are
+    skipped exactly where the tinycss tokenizer would skip them.
+    """
+
+    def __init__(self):
+        from tinycss import token_data
+        macros = token_data.COMPILED_MACROS
+        tokens = dict((name.strip(), value.format(**macros))
+                      for line in token_data.TOKENS.splitlines() if line.strip()
+                      for name, value in [line.split('\t')])
+        comment = u'{}|{}'.format(tokens['COMMENT'], tokens['BAD_COMMENT'])
+        string = u'{}|{}'.format(tokens['STRING'], tokens['BAD_STRING'])
+        # url( only starts an URI token if it does not continue an ident, hash or number.
+        uri = u'(?<![-_a-z0-9#@\u00a0-\uffff])(?:{}|{})'.format(tokens['URI'], tokens['BAD_URI'])
+        escape = u'{escape}{nmchar}*'.format(**macros)
+        # The lookahead on the first character lets the search skip the rest quickly.
+        skip = u'(?=[/"\'\\\\u])(?:{}|{}|{}|{})'.format(comment, string, uri, escape)
+        # Up to the first token of a statement
+        self.leading = re.compile(u'(?:[ \t\r\n\f]+|{}|<!--|-->)*'.format(comment), re.I)
+        self.at_keyword = re.compile(tokens['ATKEYWORD'], re.I)
+        # Brackets (and ; ending an at-rule) at the top level and inside blocks
+        self.top = re.compile(u'{}|(?P<char>[{{}}()\[\];])'.format(skip), re.I)
+        self.inner = re.compile(u'{}|(?P<char>[{{}}()\[\]])'.format(skip), re.I)
+
+    def statements(self, data):
+        '''Yields (start, block_start, end) of the top level statements, block_start is None for at-rules'''
+        closers = {'{': '}', '(': ')', '[': ']'}
+        pos = 0
+        length = len(data)
+        while True:
+            start = self.leading.match(data, pos).end()
+            if start >= length:
+                return
+            is_at_rule = self.at_keyword.match(data, start) is not None
+            block_start = None
+            stack = []
+            end = length
+            pos = start
+            while True:
+                match = (self.inner if stack else self.top).search(data, pos)
+                if match is None:
+                    # Open structures are closed at the end of the stylesheet.
+                    break
+                pos = match.end()
+                char = match.group('char')
+                if char is None:
+                    continue
+                if char in closers:
+                    if not stack and char == '{':
+                        block_start = match.start()
+                    stack.append(closers[char])
+                elif char == ';':
+                    if is_at_rule:
+                        end = pos
+                        break
+                elif stack and stack[-1] == char:
+                    # Unmatched closing brackets are ordinary tokens.
+                    stack.pop()
+                    if not stack and block_start is not None:
+                        end = pos
+                        break
+            yield start, None if is_at_rule else block_start, end
+            pos = end
+
+
+def emote_rulesets(data):
+    """
+    The rulesets of stylesheet data whose selector may be an emote's, as a stylesheet.
+
+    Most of a stylesheet is layout, tinycss only has to parse what is left.
+    At-rules are left out, parse_css() does not look into them. A selector
+    can only match re_emote if it contains href, or a comment (that tinycss
+    removes) in between.
+    """
+    global _scanner
+    if _scanner is None:
+        _scanner = _Scanner()
+    rulesets = []
+    for start, block_start, end in _scanner.statements(data):
+        if block_start is None:
+            continue
+        selector = data[start:block_start]
+        if 'href' in selector or '/*' in selector:
+            rulesets.append(data[start:end])
+    return u'\n'.join(rulesets)
+
+
+def parse_css(data):
+    '''Returns a dict of emote name to its css declarations'''
+    css = _css_parser().parse_stylesheet(emote_rulesets(data))
+
+    if not css:
+        return None
+
+    emotes_staging = defaultdict(dict)
+
+    for rule in css.rules:
+        if re_emote.match(rule.selector.as_css()):
+            for match in re_emote.finditer(rule.selector.as_css()):
+                rules = {}
+
+                for declaration in rule.declarations:
+                    if match.group(3):
+                        name = match.group(3).strip() + '-' + declaration.name
+                        rules[name] = declaration.value.as_css()
+                        emotes_staging[match.group(1)].update(rules)
+                    elif declaration.name in ['text-align',
+                                              'line-height',
+                                              'color'] or declaration.name.startswith('font') or declaration.name.startswith('text'):
+                        name = 'text-' + declaration.name
+                        rules[name] = declaration.value.as_css()
+                        emotes_staging[match.group(1)].update(rules)
+                    elif declaration.name in ['width',
+                                               'height',
+                                               'background-image',
+                                               'background-position',
+                                               'background',
+                                               'background-size',
+                                              ]:
+                        name = declaration.name
+                        if name == 'background-position':
+                            val = ['{}{}'.format(v.value, v.unit if v.unit else '') for v in declaration.value if
+                                   v.value != ' ']
+                        else:
+                            val = declaration.value[0].value
+                        if match.group(2):
+                            name = 'hover-' + name
+                        rules[name] = val
+                        emotes_staging[match.group(1)].update(rules)
+    return emotes_staging
+
+
+def cached_parse_css(content, cache=None):
+    '''
+    The (name, declarations) pairs of parse_css(), looked up in and stored
+    to cache (a ParsedStylesheetCache) if given.
+
+    The pairs keep the order of the parsed dict, which decides the order of
+    an emote's names.
+    '''
+    if cache is not None:
+        pairs = cache.get(content)
+        if pairs is not None:
+            return [tuple(pair) for pair in pairs]
+    pairs = (parse_css(content) or {}).items()
+    if cache is not None:
+        cache.put(content, pairs)
+    return pairs
+
+
+def process_stylesheet(content, subreddit, emote_info, nsfw_subreddits, image_blacklist, cache=None):
+    '''Returns the valid emotes in the stylesheet content of subreddit, None if it has none'''
+    emotes = []
+    emotes_staging = cached_parse_css(content, cache)
+    if not emotes_staging:
+        return
+
+    key_func = lambda e: e[1]
+    for emote, group in itertools.groupby(sorted(emotes_staging, key=key_func), key_func):
+        emote['names'] = [a[0].encode('ascii', 'ignore') for a in group]
+
+        full_names = []
+        for name in emote['names']:
+            full_names.append('r/'+subreddit+'/'+name)
+        emote['names'] = emote['names'] + full_names
+        emote['canonical'] = max(emote['names'], key=len)
+
+        for name in emote['names']:
+            meta_data = next((x for x in emote_info if x['name'] == name), None)
+
+
+            if meta_data:
+                for key, val in meta_data.iteritems():
+                    if key != 'name':
+                        emote[key] = val
+
+        if subreddit in nsfw_subreddits:
+            emote['nsfw'] = True
+        emote['sr'] = subreddit
+
+        validEmote = True
+
+        # Sometimes people make css errors, fix those.
+        if 'background-image' not in emote and 'background' in emote:
+            if re.match(r'^(https?:)?//', emote['background']):
+                emote['background-image'] = emote['background']
+                del emote['background']
+
+        if("background-size" in emote):
+            logger.warn("background-size found in emote {}. Removing width/height/background-size. See #8. Output possible incorrect.".format(canonical_name(emote)))
+            del emote['width']
+            del emote['height']
+            del emote['background-size']
+
+        if 'background-image' not in emote:
+            logger.warn('Discarding emotes (does not contain a background-image): {}'.format(emote['names'][0]))
+            validEmote = False
+
+        if 'background-position' in emote:
+            for backgroundPosValue in emote['background-position']:
+                if ',' in backgroundPosValue:
+                    logger.warn('Discarding emotes (Contains illegal "," in background-position css attribute): {}'.format(emote['names'][0]))
+                    validEmote = False
+
+        if 'hover-background-position' in emote:
+            for backgroundPosValue in emote['hover-background-position']:
+                if ',' in backgroundPosValue:
+                    logger.warn('Discarding emotes (Contains illegal "," in hover-background-position css attribute): {}'.format(emote['names'][0]))
+                    validEmote = False
+
+        if 'background-image' in emote:
+            if emote['background-image'] in image_blacklist:
+                logger.warn('Discarding emotes (background-image is on blacklist): {}'.format(emote['names'][0]))
+                validEmote = False
+
+        if validEmote:
+            emotes.append(emote)
+
+    return emotes
+
+
+_settings = None
+
+
+def _init_worker(emote_info, nsfw_subreddits, image_blacklist, cache):
+    global _settings
+    _settings = (emote_info, nsfw_subreddits, image_blacklist, cache)
+
+
+def _process_stylesheet_worker(args):
+    content, subreddit = args
+    return process_stylesheet(content, subreddit, *_settings)
+
+
+def create_pool(emote_info, nsfw_subreddits, image_blacklist, cache=None, processes=None):
+    '''
+    A process pool for process_stylesheets() with these settings.
+
+    Forking next to running threads can deadlock the child (a lock held by
+    another thread is never released in it), create the pool before starting
+    threads. Its workers can run any other picklable function too.
+    '''
+    from multiprocessing import Pool
+    return Pool(processes=processes, initializer=_init_worker,
+                initargs=(emote_info, nsfw_subreddits, image_blacklist, cache))
+
+
+def process_stylesheets(stylesheets, emote_info, nsfw_subreddits, image_blacklist, cache=None, processes=None, pool=None):
+    '''
+    process_stylesheet() for a list of (content, subreddit) in parallel.
+
+    pool is a create_pool() with the same settings, without one a pool is
+    created for this call. Returns the results in the order of stylesheets.
+    '''
+    stylesheets = list(stylesheets)
+    if len(stylesheets) < 2 or processes == 1:
+        return [process_stylesheet(content, subreddit, emote_info, nsfw_subreddits, image_blacklist, cache)
+                for content, subreddit in stylesheets]
+    if pool is not None:
+        return pool.map(_process_stylesheet_worker, stylesheets, chunksize=1)
+    pool = create_pool(emote_info, nsfw_subreddits, image_blacklist, cache, processes)
+    try:
+        # map() keeps the order, chunks of one spread big stylesheets evenly.
+        return pool.map(_process_stylesheet_worker, stylesheets, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
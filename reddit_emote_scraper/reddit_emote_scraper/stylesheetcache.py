@@ -0,0 +1,78 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+
+from time import time
+import hashlib
+import json
+import os
+
+from .fileutils import write_atomic
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ParsedStylesheetCache(object):
+    """
+    Stores the parse_css() result of stylesheets by the hash of their content.
+
+    The key includes the parser version, so a changed parser never sees the
+    results of an older one. Every stylesheet has its own file, processes
+    parsing at the same time can share the directory. Files that were not
+    used for max_age seconds are removed by prune().
+    """
+
+    def __init__(self, directory, version, max_age=30 * 24 * 3600):
+        self.directory = directory
+        self.version = version
+        self.max_age = max_age
+
+    def _path(self, content):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        digest = hashlib.sha1('{}\n'.format(self.version) + content).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def get(self, content):
+        '''The cached result for content, None if there is none'''
+        file_path = self._path(content)
+        try:
+            with open(file_path, 'r') as f:
+                result = json.load(f)
+        except (IOError, ValueError):
+            return None
+        try:
+            # Mark it as used for prune()
+            os.utime(file_path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, content, result):
+        write_atomic(self._path(content), [json.dumps(result, separators=(',', ':'))])
+
+    def prune(self):
+        '''Remove the results that were not used for max_age seconds'''
+        oldest = time() - self.max_age
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            file_path = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.json') and os.path.getmtime(file_path) < oldest:
+                    os.remove(file_path)
+            except OSError:
+                pass
@@ -0,0 +1,153 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Lock
+from collections import defaultdict
+from time import time
+import json
+import urlparse
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    '''Latency histogram with fixed buckets (in seconds)'''
+
+    BOUNDS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = len(self.BOUNDS)
+        for i, bound in enumerate(self.BOUNDS):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def report(self):
+        buckets = {}
+        for bound, count in zip(self.BOUNDS, self.counts):
+            buckets['<={}'.format(bound)] = count
+        buckets['>{}'.format(self.BOUNDS[-1])] = self.counts[-1]
+        return {
+            'buckets': buckets,
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+        }
+
+
+class _HostStats(object):
+    def __init__(self):
+        self.connect = Histogram()
+        self.ttfb = Histogram()
+        self.total = Histogram()
+        self.bytes = 0
+        self.status_codes = defaultdict(int)
+        self.errors = 0
+        self.retries = 0
+        self.retry_wait = 0.0
+        self.rate_limit_wait = 0.0
+
+    def report(self):
+        return {
+            'connect': self.connect.report(),
+            'time_to_first_byte': self.ttfb.report(),
+            'total': self.total.report(),
+            'bytes': self.bytes,
+            'status_codes': dict((str(k), v) for k, v in self.status_codes.iteritems()),
+            'errors': self.errors,
+            'retries': self.retries,
+            'retry_wait_seconds': self.retry_wait,
+            'rate_limit_wait_seconds': self.rate_limit_wait,
+        }
+
+
+def _host(url):
+    return urlparse.urlparse(url).hostname or ''
+
+
+class FetchTelemetry(object):
+    """
+    Per host network statistics of the fetch layer.
+
+    Collects histograms of connect time, time to first byte (until the
+    response headers are read) and total time (until the body is written),
+    transferred bytes, status codes, errors, retries and the time jobs spent
+    waiting for the rate limiter and for retry backoffs.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._hosts = defaultdict(_HostStats)
+            self._started = time()
+
+    def record_connect(self, host, seconds):
+        with self.lock:
+            self._hosts[host].connect.add(seconds)
+
+    def record_response(self, url, response):
+        with self.lock:
+            stats = self._hosts[_host(url)]
+            stats.ttfb.add(response.elapsed.total_seconds())
+            stats.status_codes[response.status_code] += 1
+
+    def record_transfer(self, url, seconds, size):
+        with self.lock:
+            stats = self._hosts[_host(url)]
+            stats.total.add(seconds)
+            stats.bytes += size
+
+    def record_error(self, url):
+        with self.lock:
+            self._hosts[_host(url)].errors += 1
+
+    def record_retry(self, url, backoff):
+        with self.lock:
+            stats = self._hosts[_host(url)]
+            stats.retries += 1
+            stats.retry_wait += backoff
+
+    def record_rate_limit_wait(self, url, seconds):
+        with self.lock:
+            self._hosts[_host(url)].rate_limit_wait += seconds
+
+    def report(self):
+        with self.lock:
+            return {
+                'duration_seconds': time() - self._started,
+                'hosts': dict((host, stats.report()) for host, stats in self._hosts.iteritems()),
+            }
+
+    def write_report(self, filename):
+        '''Writes the report as json and resets the statistics'''
+        report = self.report()
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        logger.info("Wrote network telemetry to {}".format(filename))
+        self.reset()
+        return report
@@ -0,0 +1,109 @@
+# --------------------------------------------------------------------
+#
+# Copyright (C) 2013 Daniel Triendl <daniel@pew.cc>
+#
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# COPYING for more details.
+#
+# --------------------------------------------------------------------
+
+from threading import Lock
+import json
+import os
+
+from .filelock import FileLock
+from .fileutils import write_atomic
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ValidatorStore(object):
+    """
+    Persistent store of http cache validators (ETag / Last-Modified).
+
+    For every requested url we remember the validators of the last 200 response
+    and the file in the reddit cache the response body was written to. As long
+    as that file still exists a conditional request can be made, a 304 response
+    means the cached file can be used as-is. Spritemaps are never fetched
+    again while they are cached, so in practice the stylesheets and tag
+    files are revalidated.
+
+    The file paths are stored relative to the directory of the store (the
+    reddit cache), a cache that is moved or shared by scrapers running in
+    other directories still finds its files.
+
+    Scrapers sharing a cache share the store, save() merges the entries this
+    scraper updated into the file under a lock file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.root = os.path.dirname(filename) or os.curdir
+        self.lock = Lock()
+        self._validators = {}
+        self._updated = set()
+
+        try:
+            with open(filename, 'r') as f:
+                self._validators = json.load(f)
+        except (IOError, ValueError) as ex:
+            logger.debug("Could not read validator store {}: {}".format(filename, ex))
+
+    def get(self, url):
+        '''Returns the stored entry for url if the cached file still exists'''
+        with self.lock:
+            entry = self._validators.get(url)
+        if entry:
+            entry = dict(entry, path=os.path.join(self.root, entry['path']))
+            if os.path.isfile(entry['path']):
+                return entry
+        return None
+
+    def get_path(self, url):
+        entry = self.get(url)
+        return entry['path'] if entry else None
+
+    def headers(self, url):
+        '''Returns the conditional request headers for url'''
+        entry = self.get(url)
+        headers = {}
+        if entry:
+            if entry.get('ETag'):
+                headers['If-None-Match'] = entry['ETag']
+            if entry.get('Last-Modified'):
+                headers['If-Modified-Since'] = entry['Last-Modified']
+        return headers
+
+    def update(self, url, response, file_path):
+        '''Remember the validators of a 200 response whose body was written to file_path'''
+        entry = {
+            'path': os.path.relpath(file_path, self.root),
+            'ETag': response.headers.get('ETag'),
+            'Last-Modified': response.headers.get('Last-Modified'),
+        }
+        with self.lock:
+            self._validators[url] = entry
+            self._updated.add(url)
+
+    def save(self):
+        with self.lock:
+            if not self._updated:
+                return
+            with FileLock(self.filename + '.lock'):
+                # Entries saved by other scrapers since we read the file are kept.
+                validators = {}
+                try:
+                    with open(self.filename, 'r') as f:
+                        validators = json.load(f)
+                except (IOError, ValueError):
+                    pass
+                for url in self._updated:
+                    validators[url] = self._validators[url]
+                write_atomic(self.filename, [json.dumps(validators, separators=(',', ':'), sort_keys=True)])
+            self._validators = validators
+            self._updated = set()
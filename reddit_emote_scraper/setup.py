@@ -17,7 +17,6 @@ setup(
     install_requires = [
         'requests >= 2.4.3',
         'dateutils >= 0.6.6',
-        'workerpool >= 0.9.2',
         'tinycss >= 0.3',
         'pillow >= 2.6.1',
         'pypuzzle >= 1.1',